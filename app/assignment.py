@@ -0,0 +1,84 @@
+import random
+import typing
+
+
+# Local repairs can get stuck on small, densely constrained events, in which case a fresh ring is drawn
+ATTEMPTS = 8
+
+
+class AssignmentError(Exception):
+    pass
+
+
+def exclude_pairs(groups):
+    # type: (typing.Iterable[typing.Iterable[str]]) -> typing.Set[typing.Tuple[str, str]]
+
+    # Nobody within a group (e.g. a couple) may draw anybody else from the same group
+    excluded = set()
+
+    for group in groups:
+        group = list(group)
+        for a in group:
+            for b in group:
+                if a != b:
+                    excluded.add((a, b))
+
+    return excluded
+
+
+def assign(participants, excluded=None, rng=random):
+    # type: (typing.Sequence[str], typing.Optional[typing.Container[typing.Tuple[str, str]]], random.Random) -> typing.Dict[str, str]
+
+    # Participants are shuffled into a ring and everyone gives a gift to the next person in it,
+    # which is a uniformly random single cycle (same as Sattolo's algorithm) built in O(n).
+    # Excluded (sender, recipient) pairs are repaired in place by swapping the offending recipient
+    # with another ring member, checking only the edges that swap touches. At most ATTEMPTS rings are drawn.
+    if len(participants) < 2:
+        raise AssignmentError('At least 2 participants are required.')
+
+    for _ in range(ATTEMPTS - 1):
+        try:
+            return _assign_ring(participants, excluded, rng)
+        except AssignmentError:
+            pass
+
+    return _assign_ring(participants, excluded, rng)
+
+
+def _assign_ring(participants, excluded, rng):
+    # type: (typing.Sequence[str], typing.Optional[typing.Container[typing.Tuple[str, str]]], random.Random) -> typing.Dict[str, str]
+
+    ring = list(participants)
+    rng.shuffle(ring)
+    n = len(ring)
+
+    if not excluded:
+        return dict(zip(ring, ring[1:] + ring[:1]))
+
+    def valid(i):
+        # type: (int) -> bool
+        return (ring[i % n], ring[(i + 1) % n]) not in excluded
+
+    # A repair never breaks an edge that is already valid, so one pass over the initial offenders is enough
+    offenders = [k for k, pair in enumerate(zip(ring, ring[1:] + ring[:1])) if pair in excluded]
+
+    for k in offenders:
+        if valid(k):
+            continue
+
+        target = (k + 1) % n
+        offset = rng.randrange(n)
+
+        for step in range(n):
+            j = (offset + step) % n
+            if j == target:
+                continue
+
+            ring[target], ring[j] = ring[j], ring[target]
+            if all(valid(i) for i in (k, target, j - 1, j)):
+                break
+            ring[target], ring[j] = ring[j], ring[target]
+        else:
+            raise AssignmentError('{} cannot be assigned a recipient without breaking the exclusions.'.format(ring[k]))
+
+    return dict(zip(ring, ring[1:] + ring[:1]))
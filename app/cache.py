@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+import time
+import typing
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        # type: (int) -> None
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()  # type: typing.Dict[typing.Hashable, typing.Any]
+
+    def __len__(self):
+        # type: () -> int
+
+        return len(self._items)
+
+    def __contains__(self, key):
+        # type: (typing.Hashable) -> bool
+
+        return key in self._items
+
+    def get(self, key, default=None):
+        # type: (typing.Hashable, typing.Any) -> typing.Any
+
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        # type: (typing.Hashable, typing.Any) -> typing.Any
+
+        # Same as get, but neither counts towards the statistics nor refreshes the key
+        return self._items.get(key, default)
+
+    def put(self, key, value):
+        # type: (typing.Hashable, typing.Any) -> None
+
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        # type: (typing.Hashable) -> None
+
+        self._items.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+
+        self._items.clear()
+
+
+class TTLCache(LRUCache):
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        # type: (int, float, typing.Callable[[], float]) -> None
+
+        super().__init__(max_size)
+
+        self.ttl = ttl
+        self._clock = clock
+
+    def __contains__(self, key):
+        # type: (typing.Hashable) -> bool
+
+        item = self._items.get(key)
+        return item is not None and item[0] >= self._clock()
+
+    def get(self, key, default=None):
+        # type: (typing.Hashable, typing.Any) -> typing.Any
+
+        item = self._items.get(key)
+
+        if item is None or item[0] < self._clock():
+            self._items.pop(key, None)
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def peek(self, key, default=None):
+        # type: (typing.Hashable, typing.Any) -> typing.Any
+
+        item = self._items.get(key)
+        return default if item is None or item[0] < self._clock() else item[1]
+
+    def put(self, key, value):
+        # type: (typing.Hashable, typing.Any) -> None
+
+        super().put(key, (self._clock() + self.ttl, value))
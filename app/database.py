@@ -0,0 +1,926 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import sqlite3
+import threading
+import time
+import typing
+import zlib
+
+from cache import LRUCache
+from migrations import migrate
+from storage import Context, Storage
+
+
+log = logging.getLogger(__name__)
+
+
+# Finished events are kept in a separate database file, one row per event with everything but
+# the summary compressed into a single blob
+ARCHIVE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS `archive`.`events` (
+`event_id` INTEGER PRIMARY KEY,
+`server_id` INTEGER NOT NULL,
+`archived_at` INTEGER NOT NULL,
+`state` TEXT NOT NULL,
+`budget` TEXT NOT NULL,
+`participants` INTEGER NOT NULL,
+`gifts` INTEGER NOT NULL,
+`data` BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS `archive`.`events_server_index` ON `events` (`server_id`, `event_id`);
+'''
+
+# Recipients only change while the event is collecting. Commands check the state before, but a command
+# given via DM or on another shard can still race a close or an assign, so their statements check it again.
+COLLECTING = "EXISTS (SELECT 1 FROM `servers` WHERE `server_id` = ? AND `state` = 'collecting')"
+
+
+class WriteConflict(Exception):
+    # A conditional statement did not affect the expected number of rows, e.g. because
+    # another process changed the server's state in the meantime
+    pass
+
+
+class Database(Storage):
+    # All SQLite work runs on worker threads, so a slow commit never blocks the event loop.
+    # Writes are serialized through a single connection, reads are spread over a pool of
+    # WAL-mode connections which can run concurrently with the writer.
+    #
+    # A lone write is committed right away. Writes following within COMMIT_WINDOW seconds of the last commit
+    # (up to COMMIT_BATCH of them) wait for the window to end and are committed together, each in its own
+    # savepoint, so a burst of joins pays for one fsync per window instead of one per join. A write only
+    # returns once its transaction has been committed.
+
+    READERS = 4
+    BUSY_TIMEOUT = 5000
+    SERVER_CACHE_SIZE = 10000
+    COMMIT_WINDOW = 0.02
+    COMMIT_BATCH = 500
+    # Rows per read when streaming whole-server result sets
+    CHUNK = 500
+
+    def __init__(
+            self,
+            path,
+            readers=READERS,
+            server_cache_size=SERVER_CACHE_SIZE,
+            commit_window=COMMIT_WINDOW,
+            commit_batch=COMMIT_BATCH,
+            cacheable=None,
+            archive_path=None,
+    ):
+        # type: (str, int, int, float, int, typing.Optional[typing.Callable[[str], bool]], typing.Optional[str]) -> None
+
+        self.path = path
+        # Without an archive, resetting an event simply deletes it
+        self.archive_path = archive_path
+        self.commit_window = commit_window
+        self.commit_batch = commit_batch
+        self.commits = 0
+        self.writes = 0
+        # Called from the database threads with every statement and the seconds it took
+        self.on_query = None  # type: typing.Optional[typing.Callable[[str, float], None]]
+
+        self._pending = []  # type: typing.List[typing.Tuple[typing.Sequence[typing.Tuple[str, typing.Any]], asyncio.Future]]
+        self._flush_handle = None  # type: typing.Optional[asyncio.Handle]
+        # Transactions handed to the writer thread and not committed yet, and when the last one was
+        self._committing = 0
+        self._flushed_at = 0.0
+
+        # Server state and budget only change on start, assign and reset, which write through to this cache.
+        # The generation counter keeps a read that raced with one of those writes from caching a stale row.
+        # When several processes share the database, only servers whose state is changed by this one may be cached.
+        self.server_cache = LRUCache(server_cache_size)
+        self.cacheable = cacheable
+        self._server_generation = 0
+
+        # Every worker thread opens its own connection on first use
+        self._local = threading.local()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+
+    def _connection(self):
+        # type: () -> sqlite3.Connection
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        # Transactions are managed explicitly, hence no implicit BEGIN from the sqlite3 module
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA busy_timeout = {}'.format(Database.BUSY_TIMEOUT))
+
+        if self.archive_path is not None:
+            conn.execute('ATTACH DATABASE ? AS `archive`', (self.archive_path,))
+            conn.execute('PRAGMA `archive`.journal_mode = WAL')
+
+        self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, params):
+        # type: (str, typing.Any) -> sqlite3.Cursor
+
+        started = time.perf_counter()
+
+        if isinstance(params, list):
+            cur = self._connection().executemany(sql, params)
+        else:
+            cur = self._connection().execute(sql, params)
+
+        if self.on_query is not None:
+            self.on_query(sql, time.perf_counter() - started)
+
+        return cur
+
+    def _fetch(self, sql, params):
+        # type: (str, typing.Sequence) -> typing.List[typing.Tuple]
+
+        started = time.perf_counter()
+        res = self._connection().execute(sql, params).fetchall()
+
+        if self.on_query is not None:
+            self.on_query(sql, time.perf_counter() - started)
+
+        return res
+
+    def _transaction(self, writes):
+        # type: (typing.Sequence[typing.Sequence[typing.Tuple[str, typing.Any]]]) -> typing.List[typing.Optional[Exception]]
+
+        # Every write is applied atomically within its savepoint, a failing one does not affect the others,
+        # whatever it failed with, e.g. an OverflowError binding a parameter
+        conn = self._connection()
+        errors = []  # type: typing.List[typing.Optional[Exception]]
+
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            for statements in writes:
+                conn.execute('SAVEPOINT `write`')
+
+                try:
+                    for statement in statements:
+                        cur = self._execute(*statement[:2])
+
+                        # Optional third element: the number of rows the statement has to affect
+                        if len(statement) > 2 and cur.rowcount != statement[2]:
+                            raise WriteConflict(statement[0])
+                except Exception as e:
+                    conn.execute('ROLLBACK TO `write`')
+                    errors.append(e)
+                else:
+                    errors.append(None)
+
+                conn.execute('RELEASE `write`')
+
+            self._execute('COMMIT', ())
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+        return errors
+
+    def _migrate(self, directory):
+        # type: (str) -> None
+
+        conn = self._connection()
+        migrate(conn, directory)
+
+        # Pages freed by deletes are only returned to the file system by incremental_vacuum, which needs
+        # auto_vacuum to be enabled. Switching it on for an existing database takes one full VACUUM.
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            log.info('enabled incremental vacuum', extra={'path': self.path})
+
+        if self.archive_path is not None:
+            conn.executescript(ARCHIVE_SCHEMA)
+
+    def _vacuum(self, pages):
+        # type: (int) -> int
+
+        conn = self._connection()
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        # Every step of the statement releases a single page, executescript() runs it to the end
+        started = time.perf_counter()
+        conn.executescript('PRAGMA incremental_vacuum({})'.format(int(pages)))
+
+        if self.on_query is not None:
+            self.on_query('PRAGMA incremental_vacuum', time.perf_counter() - started)
+
+        return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    async def _read(self, sql, params=()):
+        # type: (str, typing.Sequence) -> typing.List[typing.Tuple]
+
+        return await asyncio.get_event_loop().run_in_executor(self._readers, self._fetch, sql, params)
+
+    async def _write(self, *statements):
+        # type: (*typing.Tuple[str, typing.Any]) -> None
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((statements, future))
+
+        if len(self._pending) >= self.commit_batch:
+            self._flush()
+        else:
+            self._schedule_flush()
+
+        await future
+
+    def _schedule_flush(self):
+        # type: () -> None
+
+        # Writes made in the same loop iteration still end up in one transaction
+        if self._committing > 0 or self._flush_handle is not None or len(self._pending) == 0:
+            return
+
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(max(0.0, self._flushed_at + self.commit_window - loop.time()), self._flush)
+
+    def _flush(self):
+        # type: () -> None
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if len(batch) == 0:
+            return
+
+        self._committing += 1
+        self._flushed_at = asyncio.get_event_loop().time()
+
+        def done(result):
+            # type: (asyncio.Future) -> None
+
+            self._committing -= 1
+            self.commits += 1
+            self.writes += len(batch)
+
+            # Whatever was written in the meantime goes into the next transaction
+            self._schedule_flush()
+
+            if result.exception() is not None:
+                errors = [result.exception()] * len(batch)
+            else:
+                errors = result.result()
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                elif error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+        asyncio.get_event_loop().run_in_executor(
+            self._writer,
+            self._transaction,
+            [statements for statements, _ in batch],
+        ).add_done_callback(done)
+
+    async def incremental_vacuum(self, pages):
+        # type: (int) -> int
+
+        # Runs on the writer thread between two transactions, returns the number of pages released
+        return await asyncio.get_event_loop().run_in_executor(self._writer, self._vacuum, pages)
+
+    async def open(self, migrations_directory):
+        # type: (str) -> None
+
+        await asyncio.get_event_loop().run_in_executor(self._writer, self._migrate, migrations_directory)
+
+    def close(self):
+        # type: () -> None
+
+        self._flush()
+        self._readers.shutdown()
+        self._writer.shutdown()
+
+    # SERVERS
+
+    def _is_cacheable(self, server_id):
+        # type: (str) -> bool
+
+        return self.cacheable is None or self.cacheable(server_id)
+
+    def _cache_server(self, server_id, res):
+        # type: (str, typing.List[typing.Tuple[str, str]]) -> None
+
+        self._server_generation += 1
+
+        if self._is_cacheable(server_id):
+            self.server_cache.put(server_id, res)
+
+    async def warm_server_cache(self):
+        # type: () -> None
+
+        res = await self._read(
+            'SELECT CAST(`server_id` AS TEXT), `state`, `budget` FROM `servers` LIMIT ?',
+            (self.server_cache.max_size,)
+        )
+
+        for server_id, state, budget in res:
+            if self._is_cacheable(server_id):
+                self.server_cache.put(server_id, [(state, budget)])
+
+    async def get_server(self, server_id):
+        # type: (str) -> typing.List[typing.Tuple[str, str]]
+
+        cacheable = self._is_cacheable(server_id)
+
+        res = self.server_cache.get(server_id) if cacheable else None
+        if res is not None:
+            return res
+
+        generation = self._server_generation
+        res = await self._read(
+            'SELECT `state`, `budget` FROM `servers` WHERE `server_id` = ?',
+            (int(server_id),)
+        )
+
+        if cacheable and generation == self._server_generation:
+            self.server_cache.put(server_id, res)
+
+        return res
+
+    async def get_context(self, server_id, user_id, parts=frozenset()):
+        # type: (str, str, typing.AbstractSet[str]) -> Context
+
+        # The server row and the caller's rows are looked up in a single query, or not at all
+        # if the server row is cached and nothing else was asked for. Only the latter counts as a cache hit.
+        cacheable = self._is_cacheable(server_id)
+
+        if not cacheable:
+            cached = None
+        elif len(parts) == 0:
+            cached = self.server_cache.get(server_id)
+        else:
+            cached = self.server_cache.peek(server_id)
+
+        if cached is not None and len(parts) == 0:
+            return Context(*(cached[0] if cached else ('none', '')))
+
+        columns = ['`servers`.`state`', '`servers`.`budget`']
+        joins = ['LEFT JOIN `servers` ON `servers`.`server_id` = `caller`.`server_id`']
+
+        if 'counts' in parts:
+            columns += ['`servers`.`participants`', '`servers`.`gifts`']
+
+        if 'participant' in parts:
+            columns.append('`recipients`.`wish`')
+            joins.append('LEFT JOIN `recipients` ON `recipients`.`server_id` = `caller`.`server_id` '
+                         'AND `recipients`.`recipient_id` = `caller`.`user_id`')
+
+        if 'sender' in parts or 'assignment' in parts:
+            columns += ['CAST(`senders`.`recipient_id` AS TEXT)', '`senders`.`gift`']
+            joins.append('LEFT JOIN `senders` ON `senders`.`server_id` = `caller`.`server_id` '
+                         'AND `senders`.`sender_id` = `caller`.`user_id`')
+
+        if 'assignment' in parts:
+            columns.append('`assigned`.`wish`')
+            joins.append('LEFT JOIN `recipients` AS `assigned` ON `assigned`.`server_id` = `senders`.`server_id` '
+                         'AND `assigned`.`recipient_id` = `senders`.`recipient_id`')
+
+        generation = self._server_generation
+        res = await self._read(
+            'SELECT {} FROM (SELECT ? AS `server_id`, ? AS `user_id`) AS `caller` {}'.format(
+                ', '.join(columns),
+                ' '.join(joins),
+            ),
+            (int(server_id), int(user_id))
+        )
+        row = dict(zip(('state', 'budget'), res[0][:2]))
+        rest = iter(res[0][2:])
+
+        if 'counts' in parts:
+            row['participants'] = next(rest) or 0
+            row['gifts'] = next(rest) or 0
+        if 'participant' in parts:
+            row['wish'] = next(rest)
+        if 'sender' in parts or 'assignment' in parts:
+            row['recipient_id'] = next(rest)
+            row['gift'] = next(rest)
+        if 'assignment' in parts:
+            row['recipient_wish'] = next(rest)
+
+        if row['state'] is None:
+            row['state'], row['budget'] = 'none', ''
+            server = []  # type: typing.List[typing.Tuple[str, str]]
+        else:
+            server = [(row['state'], row['budget'])]
+
+        if cacheable and cached is None and generation == self._server_generation:
+            self.server_cache.put(server_id, server)
+
+        return Context(**row)
+
+    async def start_event(self, server_id, budget):
+        # type: (str, str) -> bool
+
+        try:
+            await self._write((
+                'INSERT INTO `servers` (`server_id`, `state`, `budget`) VALUES (?, ?, ?)',
+                (int(server_id), 'collecting', budget)
+            ))
+        except sqlite3.IntegrityError:
+            # Somebody else has started the event first, the cached state is stale
+            self._server_generation += 1
+            self.server_cache.pop(server_id)
+            return False
+
+        self._cache_server(server_id, [('collecting', budget)])
+        return True
+
+    async def reset_event(self, server_id):
+        # type: (str) -> None
+
+        await self._write(*self._event_deletes(server_id))
+        self._cache_server(server_id, [])
+
+    def _event_deletes(self, server_id):
+        # type: (str) -> typing.List[typing.Tuple[str, typing.Any]]
+
+        return [
+            ('DELETE FROM `servers` WHERE `server_id` = ?', (int(server_id),)),
+            ('DELETE FROM `recipients` WHERE `server_id` = ?', (int(server_id),)),
+            ('DELETE FROM `senders` WHERE `server_id` = ?', (int(server_id),)),
+            ('DELETE FROM `outbox` WHERE `server_id` = ?', (int(server_id),)),
+            ('DELETE FROM `schedule` WHERE `server_id` = ?', (int(server_id),)),
+        ]
+
+    def _set_cached_state(self, server_id, state):
+        # type: (str, str) -> None
+
+        # Keep the budget of the cached row, a missing one is simply read again on the next command
+        cached = self.server_cache.peek(server_id)
+        if cached:
+            self._cache_server(server_id, [(state, cached[0][1])])
+        else:
+            self._server_generation += 1
+            self.server_cache.pop(server_id)
+
+    async def close_event(self, server_id):
+        # type: (str) -> bool
+
+        try:
+            await self._write((
+                'UPDATE `servers` SET `state` = ? WHERE `server_id` = ? AND `state` = ?',
+                ('closed', int(server_id), 'collecting'),
+                1
+            ))
+        except WriteConflict:
+            self._server_generation += 1
+            self.server_cache.pop(server_id)
+            return False
+
+        self._set_cached_state(server_id, 'closed')
+        return True
+
+    async def assign(self, server_id, pairs):
+        # type: (str, typing.Dict[str, str]) -> bool
+
+        # Only one assignment per event can win, so that recipients are never announced twice. The pairs also
+        # have to cover exactly the participants as they are now: as many, and every sender still taking part.
+        try:
+            await self._write(
+                (
+                    '''UPDATE `servers` SET `state` = ?, `distributed_at` = ?
+                    WHERE `server_id` = ? AND `state` IN (?, ?) AND `participants` = ?''',
+                    ('distributed', int(time.time()), int(server_id), 'collecting', 'closed', len(pairs)),
+                    1
+                ),
+                (
+                    '''INSERT INTO `senders` (`server_id`, `sender_id`, `recipient_id`, `gift`) SELECT ?, ?, ?, ?
+                    WHERE EXISTS (SELECT 1 FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ?)''',
+                    [
+                        (int(server_id), int(sender_id), int(recipient_id), '', int(server_id), int(sender_id))
+                        for sender_id, recipient_id in pairs.items()
+                    ],
+                    len(pairs)
+                ),
+            )
+        except (WriteConflict, sqlite3.IntegrityError):
+            self._server_generation += 1
+            self.server_cache.pop(server_id)
+            return False
+
+        self._set_cached_state(server_id, 'distributed')
+        return True
+
+    # RECIPIENTS
+
+    async def get_recipient_ids(self, server_id):
+        # type: (str) -> typing.List[str]
+
+        res = await self._read(
+            'SELECT CAST(`recipient_id` AS TEXT) FROM `recipients` WHERE `server_id` = ?',
+            (int(server_id),)
+        )
+        return [x[0] for x in res]
+
+    async def get_recipient_page(self, server_id, after, limit):
+        # type: (str, str, int) -> typing.List[str]
+
+        # Keyset pagination, every page is a range scan of the primary key no matter how far in it starts
+        res = await self._read(
+            '''SELECT CAST(`recipient_id` AS TEXT) FROM `recipients`
+            WHERE `server_id` = ? AND `recipient_id` > ? ORDER BY `recipient_id` LIMIT ?''',
+            (int(server_id), int(after), limit)
+        )
+        return [x[0] for x in res]
+
+    async def add_recipient(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> bool
+
+        # Two joins of the same user can race each other, the unique index lets only one of them through
+        try:
+            await self._write(
+                (
+                    '''INSERT INTO `recipients` (`server_id`, `recipient_id`, `wish`)
+                    SELECT ?, ?, ? WHERE ''' + COLLECTING,
+                    (int(server_id), int(recipient_id), wish, int(server_id)),
+                    1
+                ),
+                (
+                    'UPDATE `servers` SET `participants` = `participants` + 1 WHERE `server_id` = ?',
+                    (int(server_id),)
+                ),
+            )
+        except (WriteConflict, sqlite3.IntegrityError):
+            return False
+
+        return True
+
+    async def add_recipients(self, server_id, recipient_ids):
+        # type: (str, typing.Iterable[str]) -> None
+
+        # Users who already joined are skipped, the counter is recounted once instead of per user
+        await self._write(
+            (
+                '''INSERT OR IGNORE INTO `recipients` (`server_id`, `recipient_id`, `wish`)
+                SELECT ?, ?, ? WHERE ''' + COLLECTING,
+                [(int(server_id), int(recipient_id), '', int(server_id)) for recipient_id in recipient_ids]
+            ),
+            (
+                '''UPDATE `servers` SET `participants` = (SELECT COUNT(*) FROM `recipients` WHERE `server_id` = ?)
+                WHERE `server_id` = ?''',
+                (int(server_id), int(server_id))
+            ),
+        )
+
+    async def remove_recipients(self, server_id, recipient_ids):
+        # type: (str, typing.Iterable[str]) -> None
+
+        await self._write(
+            (
+                'DELETE FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ? AND ' + COLLECTING,
+                [(int(server_id), int(recipient_id), int(server_id)) for recipient_id in recipient_ids]
+            ),
+            (
+                '''UPDATE `servers` SET `participants` = (SELECT COUNT(*) FROM `recipients` WHERE `server_id` = ?)
+                WHERE `server_id` = ?''',
+                (int(server_id), int(server_id))
+            ),
+        )
+
+    async def remove_recipient(self, server_id, recipient_id):
+        # type: (str, str) -> bool
+
+        # Nothing is deleted if a racing leave was first or the event is no longer collecting
+        try:
+            await self._write(
+                (
+                    'DELETE FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ? AND ' + COLLECTING,
+                    (int(server_id), int(recipient_id), int(server_id)),
+                    1
+                ),
+                (
+                    'UPDATE `servers` SET `participants` = `participants` - 1 WHERE `server_id` = ?',
+                    (int(server_id),)
+                ),
+            )
+        except WriteConflict:
+            return False
+
+        return True
+
+    async def set_wish(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> None
+
+        await self._write((
+            'UPDATE `recipients` SET `wish` = ? WHERE `server_id` = ? AND `recipient_id` = ?',
+            (wish, int(server_id), int(recipient_id))
+        ))
+
+    # SENDERS
+
+    async def set_gift(self, server_id, sender_id, gift):
+        # type: (str, str, str) -> None
+
+        # The counter only changes when a gift goes from empty to set or back, comparing with the previous one
+        await self._write(
+            (
+                '''UPDATE `servers` SET `gifts` = `gifts` + IFNULL(
+                    (SELECT (? != '') - (`gift` != '') FROM `senders` WHERE `server_id` = ? AND `sender_id` = ?), 0
+                ) WHERE `server_id` = ?''',
+                (gift, int(server_id), int(sender_id), int(server_id))
+            ),
+            (
+                'UPDATE `senders` SET `gift` = ? WHERE `server_id` = ? AND `sender_id` = ?',
+                (gift, int(server_id), int(sender_id))
+            ),
+        )
+
+    async def get_gifts(self, server_id, recipient_ids, chunk=CHUNK):
+        # type: (str, typing.Sequence[str], int) -> typing.List[typing.Tuple[str, str]]
+
+        # (recipient, gift) of the given recipients, looked up a chunk at a time to stay within
+        # SQLite's limit on the number of parameters
+        out = []  # type: typing.List[typing.Tuple[str, str]]
+
+        for i in range(0, len(recipient_ids), chunk):
+            ids = [int(x) for x in recipient_ids[i:i + chunk]]
+            out += await self._read(
+                '''SELECT CAST(`recipient_id` AS TEXT), `gift` FROM `senders`
+                WHERE `server_id` = ? AND `recipient_id` IN ({})'''.format(', '.join('?' * len(ids))),
+                [int(server_id)] + ids
+            )
+
+        return out
+
+    async def iter_assignments(self, server_id, chunk=CHUNK):
+        # type: (str, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str, str]]]
+
+        # Chunks of (sender, recipient, recipient's wish), read one after another by keyset on the sender,
+        # so that only a single chunk is held in memory and the first ones can be sent while reading on
+        after = 0
+
+        while True:
+            res = await self._read(
+                '''SELECT CAST(`senders`.`sender_id` AS TEXT), CAST(`senders`.`recipient_id` AS TEXT), `recipients`.`wish`
+                FROM `senders` INNER JOIN `recipients`
+                ON `recipients`.`server_id` = `senders`.`server_id` AND `recipients`.`recipient_id` = `senders`.`recipient_id`
+                WHERE `senders`.`server_id` = ? AND `senders`.`sender_id` > ?
+                ORDER BY `senders`.`sender_id` LIMIT ?''',
+                (int(server_id), after, chunk)
+            )
+
+            if len(res) > 0:
+                yield res
+            if len(res) < chunk:
+                return
+
+            after = int(res[-1][0])
+
+    async def iter_gifts(self, server_id, chunk=CHUNK):
+        # type: (str, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str]]]
+
+        # Chunks of (recipient, gift), by keyset on the recipient index
+        after = 0
+
+        while True:
+            res = await self._read(
+                '''SELECT CAST(`recipient_id` AS TEXT), `gift` FROM `senders`
+                WHERE `server_id` = ? AND `recipient_id` > ? ORDER BY `recipient_id` LIMIT ?''',
+                (int(server_id), after, chunk)
+            )
+
+            if len(res) > 0:
+                yield res
+            if len(res) < chunk:
+                return
+
+            after = int(res[-1][0])
+
+    async def iter_missing_gifts(self, server_id, reminded_before, chunk=CHUNK):
+        # type: (str, int, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str]]]
+
+        # Chunks of (sender, recipient) who have not submitted their gift and were not reminded since
+        # "reminded_before", by keyset on the sender. Only ever reads the partial index of missing gifts, which
+        # the planner would not pick by itself without statistics.
+        after = 0
+
+        while True:
+            res = await self._read(
+                '''SELECT CAST(`sender_id` AS TEXT), CAST(`recipient_id` AS TEXT)
+                FROM `senders` INDEXED BY `senders_missing_gift_index`
+                WHERE `server_id` = ? AND `gift` = '' AND `sender_id` > ? AND IFNULL(`reminded_at`, 0) < ?
+                ORDER BY `sender_id` LIMIT ?''',
+                (int(server_id), after, reminded_before, chunk)
+            )
+
+            if len(res) > 0:
+                yield res
+            if len(res) < chunk:
+                return
+
+            after = int(res[-1][0])
+
+    async def get_missing_gift_page(self, server_id, after, limit):
+        # type: (str, str, int) -> typing.List[str]
+
+        res = await self._read(
+            '''SELECT CAST(`sender_id` AS TEXT) FROM `senders` INDEXED BY `senders_missing_gift_index`
+            WHERE `server_id` = ? AND `gift` = '' AND `sender_id` > ? ORDER BY `sender_id` LIMIT ?''',
+            (int(server_id), int(after), limit)
+        )
+        return [x[0] for x in res]
+
+    async def set_reminded(self, server_id, sender_ids, reminded_at):
+        # type: (str, typing.Iterable[str], int) -> None
+
+        await self._write((
+            'UPDATE `senders` SET `reminded_at` = ? WHERE `server_id` = ? AND `sender_id` = ?',
+            [(reminded_at, int(server_id), int(sender_id)) for sender_id in sender_ids]
+        ))
+
+    # OUTBOX
+
+    async def queue_messages(self, server_id, kind, messages, resend=False):
+        # type: (str, str, typing.Sequence[typing.Tuple[str, str]], bool) -> None
+
+        # Messages which were already delivered are left alone unless explicitly resent,
+        # failed ones are queued again with their new content. Spelled as an update followed by an insert
+        # rather than an upsert, which needs SQLite 3.24.
+        await self._write(
+            (
+                '''UPDATE `outbox` SET `content` = ?, `state` = 'pending'
+                WHERE `server_id` = ? AND `kind` = ? AND `user_id` = ?''' + ('' if resend else " AND `state` != 'sent'"),
+                [(content, int(server_id), kind, int(user_id)) for user_id, content in messages]
+            ),
+            (
+                'INSERT OR IGNORE INTO `outbox` (`server_id`, `kind`, `user_id`, `content`) VALUES (?, ?, ?, ?)',
+                [(int(server_id), kind, int(user_id), content) for user_id, content in messages]
+            ),
+        )
+
+    async def get_pending_messages(self, after, limit, shard_id=0, shard_count=1):
+        # type: (typing.Tuple[str, str, str], int, int, int) -> typing.List[typing.Tuple[str, str, str, str]]
+
+        # Keyset pagination over the pending messages of the servers belonging to the given shard. The key
+        # comparison is spelled out instead of using row values, which need SQLite 3.15, and starts with
+        # a plain bound on the server, so the scan still starts at the right place in the index.
+        return await self._read(
+            '''SELECT CAST(`server_id` AS TEXT), `kind`, CAST(`user_id` AS TEXT), `content` FROM `outbox`
+            WHERE `state` = 'pending' AND `server_id` >= ?
+            AND (`server_id` > ? OR `kind` > ? OR (`kind` = ? AND `user_id` > ?)) AND (`server_id` >> 22) % ? = ?
+            ORDER BY `server_id`, `kind`, `user_id` LIMIT ?''',
+            (int(after[0]), int(after[0]), after[1], after[1], int(after[2]), shard_count, shard_id, limit)
+        )
+
+    async def set_message_state(self, server_id, kind, user_id, state):
+        # type: (str, str, str, str) -> None
+
+        await self._write((
+            '''UPDATE `outbox` SET `state` = ?, `attempts` = `attempts` + 1
+            WHERE `server_id` = ? AND `kind` = ? AND `user_id` = ?''',
+            (state, int(server_id), kind, int(user_id))
+        ))
+
+    async def count_messages(self, server_id, kind):
+        # type: (str, str) -> typing.Dict[str, int]
+
+        res = await self._read(
+            'SELECT `state`, COUNT(*) FROM `outbox` WHERE `server_id` = ? AND `kind` = ? GROUP BY `state`',
+            (int(server_id), kind)
+        )
+        return dict(res)
+
+    # SCHEDULE
+
+    async def schedule_action(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        await self._write((
+            'INSERT OR REPLACE INTO `schedule` (`server_id`, `action`, `run_at`, `channel_id`) VALUES (?, ?, ?, ?)',
+            (int(server_id), action, run_at, int(channel_id))
+        ))
+
+    async def unschedule_action(self, server_id, action, run_at=None):
+        # type: (str, str, typing.Optional[int]) -> None
+
+        if run_at is None:
+            await self._write((
+                'DELETE FROM `schedule` WHERE `server_id` = ? AND `action` = ?',
+                (int(server_id), action)
+            ))
+        else:
+            await self._write((
+                'DELETE FROM `schedule` WHERE `server_id` = ? AND `action` = ? AND `run_at` = ?',
+                (int(server_id), action, run_at)
+            ))
+
+    async def get_scheduled_actions(self, shard_id=0, shard_count=1):
+        # type: (int, int) -> typing.List[typing.Tuple[str, str, int, str]]
+
+        return await self._read(
+            '''SELECT CAST(`server_id` AS TEXT), `action`, `run_at`, CAST(`channel_id` AS TEXT) FROM `schedule`
+            WHERE (`server_id` >> 22) % ? = ?''',
+            (shard_count, shard_id)
+        )
+
+    # ARCHIVE
+
+    def _dump_event(self, server_id):
+        # type: (str) -> typing.Optional[typing.Tuple]
+
+        # Runs on a reader thread, compressing a big event would hold up the event loop
+        server = self._fetch(
+            'SELECT `state`, `budget`, `participants`, `gifts` FROM `servers` WHERE `server_id` = ?',
+            (int(server_id),)
+        )
+        if len(server) == 0:
+            return None
+
+        # Only whether a gift was submitted, gifts are codes which must not outlive the event
+        res = self._fetch(
+            '''SELECT CAST(`recipients`.`recipient_id` AS TEXT), `recipients`.`wish`,
+            CAST(`senders`.`recipient_id` AS TEXT), `senders`.`gift` != ''
+            FROM `recipients` LEFT JOIN `senders`
+            ON `senders`.`server_id` = `recipients`.`server_id` AND `senders`.`sender_id` = `recipients`.`recipient_id`
+            WHERE `recipients`.`server_id` = ?''',
+            (int(server_id),)
+        )
+        data = zlib.compress(json.dumps([
+            {
+                'user_id': user_id,
+                'wish': wish,
+                'recipient_id': recipient_id,
+                'submitted': None if submitted is None else bool(submitted),
+            }
+            for user_id, wish, recipient_id, submitted in res
+        ]).encode('utf-8'))
+
+        state, budget, participants, gifts = server[0]
+        return int(server_id), int(time.time()), state, budget, participants, gifts, data
+
+    async def archive_event(self, server_id):
+        # type: (str) -> bool
+
+        # Moves the event to the archive and deletes it from the live tables. Without an archive it is only
+        # deleted and False is returned, as it is if there is no event.
+        if self.archive_path is None:
+            await self.reset_event(server_id)
+            return False
+
+        dump = await asyncio.get_event_loop().run_in_executor(self._readers, self._dump_event, server_id)
+        if dump is None:
+            return False
+
+        await self._write(
+            (
+                '''INSERT INTO `archive`.`events`
+                (`server_id`, `archived_at`, `state`, `budget`, `participants`, `gifts`, `data`)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                dump
+            ),
+            *self._event_deletes(server_id)
+        )
+        self._cache_server(server_id, [])
+
+        return True
+
+    async def get_finished_events(self, before, shard_id=0, shard_count=1):
+        # type: (int, int, int) -> typing.List[str]
+
+        res = await self._read(
+            '''SELECT CAST(`server_id` AS TEXT) FROM `servers`
+            WHERE `state` = 'distributed' AND `distributed_at` < ? AND (`server_id` >> 22) % ? = ?''',
+            (before, shard_count, shard_id)
+        )
+        return [x[0] for x in res]
+
+    async def get_archived_events(self, server_id, limit):
+        # type: (str, int) -> typing.List[typing.Tuple[int, int, str, str, int, int]]
+
+        if self.archive_path is None:
+            return []
+
+        return await self._read(
+            '''SELECT `event_id`, `archived_at`, `state`, `budget`, `participants`, `gifts` FROM `archive`.`events`
+            WHERE `server_id` = ? ORDER BY `event_id` DESC LIMIT ?''',
+            (int(server_id), limit)
+        )
+
+    async def get_archived_event(self, server_id, event_id):
+        # type: (str, int) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]
+
+        if self.archive_path is None:
+            return None
+
+        res = await self._read(
+            'SELECT `data` FROM `archive`.`events` WHERE `server_id` = ? AND `event_id` = ?',
+            (int(server_id), event_id)
+        )
+        if len(res) == 0:
+            return None
+
+        return json.loads(zlib.decompress(res[0][0]).decode('utf-8'))
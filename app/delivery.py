@@ -0,0 +1,251 @@
+from collections import deque
+
+import asyncio
+import itertools
+import logging
+import random
+import time
+import typing
+
+import discord
+
+from ratelimit import TokenBucket
+from users import UserDirectory
+
+
+log = logging.getLogger(__name__)
+
+
+class DeliveryJob:
+    def __init__(self, job_id, server_id, kind, total, interactive=False):
+        # type: (int, str, str, int, bool) -> None
+
+        self.id = job_id
+        self.server_id = server_id
+        self.kind = kind
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.created = time.time()
+        self.finished = None  # type: typing.Optional[float]
+        # Answers a command of a waiting user rather than fanning out to a whole server
+        self.interactive = interactive
+        # Called with the destination and whether the message was delivered, once it is final
+        self.on_result = None  # type: typing.Optional[typing.Callable[[typing.Any, bool], None]]
+
+    @property
+    def pending(self):
+        # type: () -> int
+
+        return self.total - self.sent - self.failed
+
+    def describe(self):
+        # type: () -> str
+
+        out = 'Job {} ({}): {}/{} delivered, {} failed, {} pending'.format(
+            self.id,
+            self.kind,
+            self.sent,
+            self.total,
+            self.failed,
+            self.pending,
+        )
+
+        if self.finished is not None:
+            out += ', finished in {:.1f} s'.format(self.finished - self.created)
+
+        return out + '.'
+
+
+class DeliveryScheduler:
+    # Outgoing DMs are put into a single queue served by a fixed number of workers, every send takes
+    # a token from the bucket of its route first. Failed sends are put back into the queue after
+    # an exponential backoff instead of holding a worker.
+    #
+    # Messages of interactive jobs, e.g. the answer to a "who", go ahead of all bulk ones, so that a fan-out
+    # to a large server does not hold up the DMs other users were just promised. Otherwise messages are sent
+    # in the order they were queued.
+
+    CONCURRENCY = 8
+    # Route name -> (requests per second, burst)
+    ROUTES = {
+        'dm': (5.0, 5),
+    }
+    RETRIES = 5
+    BACKOFF = 1.0
+    JOBS_PER_SERVER = 5
+
+    def __init__(
+            self,
+            client,
+            concurrency=CONCURRENCY,
+            routes=None,
+            retries=RETRIES,
+            backoff=BACKOFF,
+            users=None,
+    ):
+        # type: (discord.Client, int, typing.Optional[typing.Dict[str, typing.Tuple[float, float]]], int, float, typing.Optional[UserDirectory]) -> None
+
+        self.client = client
+        self.users = users
+        self.concurrency = concurrency
+        self.routes = DeliveryScheduler.ROUTES if routes is None else routes
+        self.retries = retries
+        self.backoff = backoff
+
+        self.buckets = {}  # type: typing.Dict[str, TokenBucket]
+        self.jobs = {}  # type: typing.Dict[str, typing.Deque[DeliveryJob]]
+
+        self._queue = None  # type: typing.Optional[asyncio.PriorityQueue]
+        self._workers = []  # type: typing.List[asyncio.Future]
+        self._job_ids = itertools.count(1)
+        # Keeps messages of the same priority in order
+        self._sequence = itertools.count()
+
+    @property
+    def queue_depth(self):
+        # type: () -> int
+
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def _bucket(self, route):
+        # type: (str) -> TokenBucket
+
+        if route not in self.buckets:
+            self.buckets[route] = TokenBucket(*self.routes[route])
+
+        return self.buckets[route]
+
+    def _start(self):
+        # type: () -> None
+
+        # Workers are started lazily, so that they end up in the loop the client is running in
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+
+    def close(self):
+        # type: () -> None
+
+        for worker in self._workers:
+            worker.cancel()
+
+        self._queue = None
+        self._workers = []
+
+    def submit(self, server_id, kind, messages, route='dm', track=True, on_result=None, interactive=False):
+        # type: (str, str, typing.Sequence[typing.Tuple[discord.User, typing.Any]], str, bool, typing.Optional[typing.Callable[[typing.Any, bool], None]], bool) -> DeliveryJob
+
+        # Message content is either a string or a coroutine function returning one
+        self._start()
+
+        job = DeliveryJob(next(self._job_ids), server_id, kind, 0, interactive)
+        job.on_result = on_result
+
+        if track:
+            if server_id not in self.jobs:
+                self.jobs[server_id] = deque(maxlen=DeliveryScheduler.JOBS_PER_SERVER)
+            self.jobs[server_id].append(job)
+
+        self.extend(job, messages, route)
+
+        return job
+
+    def extend(self, job, messages, route='dm'):
+        # type: (DeliveryJob, typing.Sequence[typing.Tuple[discord.User, typing.Any]], str) -> None
+
+        # Adds messages to a submitted job, for fan-outs which are read from the database in chunks
+        self._start()
+
+        job.total += len(messages)
+
+        for destination, content in messages:
+            self._put((job, route, destination, content, 0))
+
+        job.finished = time.time() if job.pending == 0 else None
+
+    def progress(self, server_id):
+        # type: (str) -> typing.List[DeliveryJob]
+
+        return list(self.jobs.get(server_id, ()))
+
+    def _done(self, job, destination, success):
+        # type: (DeliveryJob, typing.Any, bool) -> None
+
+        if job.on_result is not None:
+            job.on_result(destination, success)
+
+        if success:
+            job.sent += 1
+        else:
+            job.failed += 1
+
+        if job.pending == 0:
+            job.finished = time.time()
+
+    def _put(self, item):
+        # type: (typing.Tuple) -> None
+
+        self._queue.put_nowait((0 if item[0].interactive else 1, next(self._sequence), item))
+
+    def _retry(self, item):
+        # type: (typing.Tuple) -> None
+
+        # The scheduler might have been closed in the meantime
+        if self._queue is not None:
+            self._put(item)
+
+    async def _worker(self):
+        # type: () -> None
+
+        while True:
+            _, _, item = await self._queue.get()
+
+            try:
+                await self._deliver(*item)
+            except Exception:
+                log.exception('delivery failed unexpectedly', extra={'job_id': item[0].id, 'server_id': item[0].server_id})
+                self._done(item[0], item[2], False)
+
+    async def _deliver(self, job, route, destination, content, attempt):
+        # type: (DeliveryJob, str, discord.User, typing.Any, int) -> None
+
+        bucket = self._bucket(route)
+        await bucket.acquire()
+
+        try:
+            if callable(content):
+                content = await content()
+
+            # Sending to a known DM channel saves opening it again for every message
+            target = destination
+            if self.users is not None and isinstance(destination, discord.User):
+                target = await self.users.get_channel(destination)
+
+            await self.client.send_message(target, content)
+
+        except discord.Forbidden:
+            # The user does not accept DMs, retrying will not help
+            self._done(job, destination, False)
+
+        except (discord.HTTPException, asyncio.TimeoutError, OSError) as e:
+            if isinstance(e, discord.NotFound) and self.users is not None:
+                self.users.channels.pop(destination.id)
+
+            if attempt >= self.retries:
+                self._done(job, destination, False)
+                return
+
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+
+            response = getattr(e, 'response', None)
+            if getattr(response, 'status', None) == 429:
+                # Everyone on this route has to wait out the rate limit, not just this message
+                retry_after = float(getattr(response, 'headers', {}).get('Retry-After', self.backoff))
+                bucket.penalize(retry_after)
+                delay = max(delay, retry_after)
+
+            asyncio.get_event_loop().call_later(delay, self._retry, (job, route, destination, content, attempt + 1))
+
+        else:
+            self._done(job, destination, True)
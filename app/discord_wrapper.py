@@ -2,8 +2,50 @@ from collections import OrderedDict
 
 import asyncio
 import discord
+import importlib
+import logging
+import re
+import sys
+import time
 import typing
 
+from dispatcher import Dispatcher
+from metrics import Metrics
+from ratelimit import Throttle
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_id(text):
+    # type: (str) -> typing.Optional[str]
+
+    # User and server IDs are decimal 64-bit integers, which SQLite stores as signed ones. Anything else,
+    # including non-ASCII digits which str.isnumeric() lets through, is not an ID.
+    if re.fullmatch(r'[0-9]+', text) is None or int(text) >= 2 ** 63:
+        return None
+
+    return str(int(text))
+
+
+def split_message(text, limit):
+    # type: (str, int) -> typing.List[str]
+
+    # Splits at line breaks where possible, a single line which is too long is cut
+    parts = []
+
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+
+        if cut <= 0:
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+
+    return parts + [text]
+
 
 class DiscordBotCommand:
     def __init__(
@@ -15,8 +57,11 @@ class DiscordBotCommand:
             can_run_direct=True,
             can_run_server=True,
             is_hidden=False,
+            rate_limits=None,
+            can_overlap=False,
+            exempt_limits=(),
     ):
-        # type: (str, typing.Callable, str, discord.Permissions, bool, bool, bool) -> None
+        # type: (str, typing.Callable, str, discord.Permissions, bool, bool, bool, typing.Optional[typing.Dict[str, typing.Tuple[float, float]]], bool, typing.Iterable[str]) -> None
 
         self.name = name
         self.function = function
@@ -25,84 +70,206 @@ class DiscordBotCommand:
         self.can_run_direct = can_run_direct
         self.can_run_server = can_run_server
         self.is_hidden = is_hidden
+        # Scope ("user", "server" or "global") -> (commands per second, burst), on top of the bot-wide limits
+        self.rate_limits = rate_limits
+        # Scopes of the bot-wide limits the command does not count towards, it should set its own for them
+        self.exempt_limits = exempt_limits
+        # Runs alongside the server's other overlapping commands by other users, see Dispatcher. Only for commands
+        # which write nothing but their caller's rows, with writes checking the event's state by themselves, and
+        # read nothing but those rows and the server's counters.
+        self.can_overlap = can_overlap
 
 
 class DiscordBot:
     LENGTH_LIMIT = 1000
+    # Longest message Discord accepts, longer replies are sent as several messages
+    MESSAGE_LIMIT = 2000
 
-    def __init__(self, token, prefix='!'):
-        # type: (str, str) -> None
+    def __init__(self, token, prefix='!', rate_limits=None, metrics=None, shard_id=None, shard_count=None):
+        # type: (str, str, typing.Optional[typing.Dict[str, typing.Tuple[float, float]]], typing.Optional[Metrics], typing.Optional[int], typing.Optional[int]) -> None
 
         self.token = token
         self.prefix = prefix
+        self.throttle = Throttle(rate_limits)
+        self.metrics = Metrics() if metrics is None else metrics
+        self.dispatcher = Dispatcher()
 
-        self.client = discord.Client()
+        if shard_count is None:
+            self.client = discord.Client()
+        else:
+            self.client = discord.Client(shard_id=shard_id, shard_count=shard_count)
         self.commands = OrderedDict()  # type: typing.Dict[str, DiscordBotCommand]
 
         @self.client.event
         async def on_message(message):
             # type: (discord.Message) -> None
 
-            # Skip bot's own messages
-            if message.author == self.client.user:
-                return
+            await self.handle_message(message)
 
-            # Skip messages without a valid prefix
-            if not message.content.startswith(self.prefix):
-                return
+        @self.client.event
+        async def on_ready():
+            log.info('logged in', extra={
+                'user': '{}#{}'.format(self.client.user.name, self.client.user.discriminator),
+                'user_id': self.client.user.id,
+            })
+
+    async def handle_message(self, message):
+        # type: (discord.Message) -> None
 
-            print(message.author.name, message.content)
+        # Skip bot's own messages
+        if message.author == self.client.user:
+            return
 
-            # Split message into command and payload
-            message_in = message.content.strip().split(maxsplit=1)  # type: str
-            command_in = message_in[0][len(self.prefix):]
-            payload_in = '' if len(message_in) < 2 else message_in[1]
+        # Skip messages without a valid prefix
+        if not message.content.startswith(self.prefix):
+            return
 
-            if command_in not in self.commands:
-                payload_out = 'The specified command was not found.'.format(command_in)
+        # Split message into command and payload
+        message_in = message.content.strip().split(maxsplit=1)  # type: str
+        command_in = message_in[0][len(self.prefix):]
+        payload_in = '' if len(message_in) < 2 else message_in[1]
 
-            elif len(payload_in) > DiscordBot.LENGTH_LIMIT:
-                payload_out = 'Input message is too long.'
+        # Payloads are left out, they can contain gifts
+        log.info('command', extra={
+            'command': command_in,
+            'user_id': message.author.id,
+            'server_id': None if message.server is None else message.server.id,
+            'length': len(payload_in),
+        })
 
+        # Throttle before doing any actual work, unknown commands only take from the bot-wide buckets
+        command = self.commands.get(command_in)
+        throttled = self.throttle.check(
+            command_in if command is not None else '',
+            None if command is None else command.rate_limits,
+            message.author.id,
+            None if message.server is None else message.server.id,
+            () if command is None else command.exempt_limits,
+        )
+
+        if throttled is not None:
+            if not self.throttle.should_warn(throttled, message.author.id):
+                return
+
+            payload_out = 'You are sending commands too fast, please slow down.'
+
+        else:
+            # Commands of a server run in order, also those given via DM for it, other direct messages
+            # are ordered per user
+            if message.server is not None:
+                key = message.server.id
             else:
-                command = self.commands[command_in]
+                key = parse_id(payload_in.split(' ', 1)[0]) or ('dm', message.author.id)
+
+            overlap = message.author.id if command is not None and command.can_overlap else None
 
-                # Server-only commands
-                if message.server is None and not command.can_run_direct:
-                    payload_out = 'The specified command can be executed in servers only.'
+            try:
+                payload_out = await self.dispatcher.submit(
+                    key,
+                    self.execute,
+                    message,
+                    command_in,
+                    payload_in,
+                    overlap=overlap,
+                )
+            except asyncio.QueueFull:
+                payload_out = 'There are too many commands waiting to be processed, please try again in a moment.'
 
-                # Direct-only commands
-                elif message.server is not None and not command.can_run_server:
-                    payload_out = 'The specified command can be executed via direct messages only.'
+        if payload_out != '':
+            # Mention user when running command in non-private channels
+            if not message.channel.is_private:
+                payload_out = '<@{}> '.format(message.author.id) + payload_out
 
-                # Permission checking
-                # TODO Implement permission checking outside of servers
-                elif message.server is not None and \
-                        not command.required_permissions.is_subset(message.author.server_permissions):
-                    payload_out = 'You do not have permission to perform the specified command.'
+            for part in split_message(payload_out, DiscordBot.MESSAGE_LIMIT):
+                # noinspection PyUnresolvedReferences
+                await self.client.send_message(message.channel, part)
+
+    async def execute(self, message, command_in, payload_in):
+        # type: (discord.Message, str, str) -> str
+
+        command = self.commands.get(command_in)
+
+        if command is None:
+            payload_out = 'The specified command was not found.'.format(command_in)
+
+        elif len(payload_in) > DiscordBot.LENGTH_LIMIT:
+            payload_out = 'Input message is too long.'
+
+        else:
+            # Server-only commands
+            if message.server is None and not command.can_run_direct:
+                payload_out = 'The specified command can be executed in servers only.'
 
-                # When all checks passed, execute the command and retrieve the payload
+            # Direct-only commands
+            elif message.server is not None and not command.can_run_server:
+                payload_out = 'The specified command can be executed via direct messages only.'
+
+            # Permission checking
+            # TODO Implement permission checking outside of servers
+            elif message.server is not None and \
+                    not command.required_permissions.is_subset(message.author.server_permissions):
+                payload_out = 'You do not have permission to perform the specified command.'
+
+            # When all checks passed, execute the command and retrieve the payload
+            else:
+                started = time.perf_counter()
+
+                if asyncio.iscoroutinefunction(command.function):
+                    payload_out = await command.function(message, payload_in)
                 else:
-                    if asyncio.iscoroutinefunction(command.function):
-                        payload_out = await command.function(message, payload_in)
-                    else:
-                        payload_out = command.function(message, payload_in)
+                    payload_out = command.function(message, payload_in)
 
-            if payload_out != '':
-                # Mention user when running command in non-private channels
-                if not message.channel.is_private:
-                    payload_out = '<@{}> '.format(message.author.id) + payload_out
+                self.metrics.inc('santabot_commands_total', command=command.name)
+                self.metrics.observe('santabot_command_seconds', time.perf_counter() - started, command=command.name)
 
-                # noinspection PyUnresolvedReferences
-                await self.client.send_message(message.channel, payload_out)
+        return payload_out
 
-        @self.client.event
-        async def on_ready():
-            print('Logged in as {}#{} (id {})'.format(
-                self.client.user.name,
-                self.client.user.discriminator,
-                self.client.user.id
-            ))
+    def load_commands(self, package, registries=()):
+        # type: (str, typing.Iterable[typing.Dict[str, typing.Callable]]) -> None
+
+        # Imports the package and its modules afresh, and replaces the commands defined in them with the ones
+        # they register now. The bot is only switched over once everything was imported, so if any module
+        # fails to, it keeps the commands it had. Commands which are already running carry on with the code
+        # they started with, the old modules are simply no longer imported.
+        #
+        # Registries are other dictionaries of name -> function the modules register into, e.g. scheduled
+        # actions. They are switched over and restored along with the commands.
+        def is_part(name):
+            # type: (str) -> bool
+
+            return name == package or name.startswith(package + '.')
+
+        old_modules = {name: module for name, module in sys.modules.items() if is_part(name)}
+        old_commands = self.commands
+        old_registries = [(registry, dict(registry)) for registry in registries]
+
+        for name in old_modules:
+            del sys.modules[name]
+
+        self.commands = OrderedDict(
+            (name, command) for name, command in old_commands.items() if not is_part(command.function.__module__)
+        )
+
+        for registry, old in old_registries:
+            for name, function in old.items():
+                if is_part(function.__module__):
+                    del registry[name]
+
+        try:
+            importlib.invalidate_caches()
+            importlib.import_module(package)
+        except BaseException:
+            for name in [name for name in sys.modules if is_part(name)]:
+                del sys.modules[name]
+
+            sys.modules.update(old_modules)
+            self.commands = old_commands
+
+            for registry, old in old_registries:
+                registry.clear()
+                registry.update(old)
+
+            raise
 
     def command(self, name, *args, **kwargs):
         def decorator(func):
@@ -0,0 +1,144 @@
+from collections import deque
+
+import asyncio
+import typing
+
+
+class Dispatcher:
+    # Commands are queued per server and served by a fixed pool of workers. A worker takes a server,
+    # runs the oldest of its commands and puts the server back at the end of the line, so the commands
+    # of one server run strictly one after another while different servers run side by side.
+    #
+    # Commands submitted with an overlap group (e.g. the user's ID for a join) are the exception: the worker
+    # starts them and moves on right away, so that the joins of a storm read side by side and their writes
+    # end up in shared transactions. A command waits for the unfinished ones of its server before it starts
+    # if it has no overlap group, e.g. an assign, or if it has the same one.
+    #
+    # Every server's queue holds at most QUEUE_SIZE commands, further ones are rejected. Once MAX_PENDING
+    # commands are waiting in total, submitting waits until some of them are done.
+
+    WORKERS = 16
+    QUEUE_SIZE = 50
+    MAX_PENDING = 5000
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, max_pending=MAX_PENDING):
+        # type: (int, int, int) -> None
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_pending = max_pending
+
+        self.pending = 0
+        self.rejected = 0
+        self.queues = {}  # type: typing.Dict[typing.Hashable, typing.Deque[typing.Tuple[typing.Callable, typing.Tuple, typing.Hashable, asyncio.Future]]]
+        # Key -> overlapping commands which have not finished yet -> their overlap group
+        self.overlapping = {}  # type: typing.Dict[typing.Hashable, typing.Dict[asyncio.Future, typing.Hashable]]
+
+        self._ready = None  # type: typing.Optional[asyncio.Queue]
+        self._room = None  # type: typing.Optional[asyncio.Event]
+        self._workers = []  # type: typing.List[asyncio.Future]
+
+    def _start(self):
+        # type: () -> None
+
+        # Workers are started lazily, so that they end up in the loop the client is running in
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._room = asyncio.Event()
+            self._room.set()
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def close(self):
+        # type: () -> None
+
+        for worker in self._workers:
+            worker.cancel()
+
+        self._ready = None
+        self._workers = []
+
+    def busiest(self, count):
+        # type: (int) -> typing.List[typing.Tuple[typing.Hashable, int]]
+
+        return sorted(((key, len(queue)) for key, queue in self.queues.items()), key=lambda x: -x[1])[:count]
+
+    async def submit(self, key, function, *args, overlap=None):
+        # type: (typing.Hashable, typing.Callable[..., typing.Awaitable], *typing.Any, typing.Hashable) -> typing.Any
+
+        # Returns what the coroutine function returned once it has run, raises asyncio.QueueFull
+        # if the queue of the key is full
+        self._start()
+
+        while self.pending >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+
+        queue = self.queues.get(key)
+
+        # Overlapping commands have left the queue, but still count towards its size
+        if (0 if queue is None else len(queue)) + len(self.overlapping.get(key, {})) >= self.queue_size:
+            self.rejected += 1
+            raise asyncio.QueueFull()
+
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self._ready.put_nowait(key)
+
+        future = asyncio.get_event_loop().create_future()
+        queue.append((function, args, overlap, future))
+        self.pending += 1
+
+        return await future
+
+    async def _run(self, function, args, future):
+        # type: (typing.Callable, typing.Tuple, asyncio.Future) -> None
+
+        try:
+            result = await function(*args)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.pending -= 1
+            self._room.set()
+
+    def _forget(self, key, task):
+        # type: (typing.Hashable, asyncio.Future) -> None
+
+        overlapping = self.overlapping[key]
+        del overlapping[task]
+
+        if len(overlapping) == 0:
+            del self.overlapping[key]
+
+    async def _worker(self):
+        # type: () -> None
+
+        while True:
+            key = await self._ready.get()
+            queue = self.queues[key]
+            function, args, overlap, future = queue[0]
+
+            overlapping = self.overlapping.get(key, {})
+            waiting_for = [task for task, group in overlapping.items() if overlap is None or group == overlap]
+            if len(waiting_for) > 0:
+                await asyncio.wait(waiting_for)
+
+            if overlap is None:
+                await self._run(function, args, future)
+            else:
+                task = asyncio.ensure_future(self._run(function, args, future))
+                self.overlapping.setdefault(key, {})[task] = overlap
+                task.add_done_callback(lambda x, key=key: self._forget(key, x))
+
+            queue.popleft()
+
+            # A server stays known to the dispatcher while it has queued commands, and is in the ready
+            # queue at most once, so no two workers ever start its commands at the same time
+            if len(queue) > 0:
+                self._ready.put_nowait(key)
+            else:
+                del self.queues[key]
@@ -0,0 +1,3 @@
+# Commands are registered with the bot when their modules are imported, in the order they are listed in help.
+# Modules look up the services they use on the santabot module when a command runs, not when they are imported.
+from handlers import participant, general, event, listing, admin  # noqa: F401
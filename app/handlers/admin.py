@@ -0,0 +1,196 @@
+import asyncio
+import cProfile
+import discord
+import json
+import logging
+import os
+import pstats
+import re
+import time
+import typing
+
+import santabot
+
+from discord_wrapper import DiscordBot, split_message
+from santabot import MANAGEMENT_PERMISSIONS, OWNER_IDS, PROFILE_FILE, PROFILE_MAX_SECONDS, SHARD_ID, bot
+
+
+log = logging.getLogger(__name__)
+
+
+@bot.command(
+    'throttled',
+    description='Show how many commands were let through and throttled, to tune the rate limits.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    is_hidden=True,
+)
+def cmd_throttled(message, data):
+    # type: (discord.Message, str) -> str
+
+    # Counts commands of every server of this shard, and permissions are not checked in DMs
+    if message.author.id not in OWNER_IDS:
+        return 'Only the owners of the bot can see how many commands were throttled.'
+
+    throttled = bot.throttle.throttled.most_common(10)
+
+    out = 'Commands let through: {}.'.format(sum(bot.throttle.allowed.values()))
+    if len(throttled) > 0:
+        out += ' Most throttled:\n' + '\n'.join(
+            '`{}` per {}: {}'.format(command or '(unknown)', scope, count)
+            for (command, scope), count in throttled
+        )
+
+    return out
+
+
+@bot.command(
+    'stats',
+    description='Show command latencies, database timings and delivery queue depth.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    is_hidden=True,
+)
+def cmd_stats(message, data):
+    # type: (discord.Message, str) -> str
+
+    # Shows every server of this shard, so server permissions are not enough
+    if message.author.id not in OWNER_IDS:
+        return 'Only the owners of the bot can see its statistics.'
+
+    commands = sorted(
+        santabot.metrics.histogram_items('santabot_command_seconds'),
+        key=lambda x: x[1].count,
+        reverse=True,
+    )
+    statements = sorted(
+        santabot.metrics.histogram_items('santabot_sql_seconds'),
+        key=lambda x: x[1].sum,
+        reverse=True,
+    )[:5]
+    loop_lag = santabot.metrics.histogram_items('santabot_loop_lag_seconds')
+    cache = santabot.db.server_cache
+
+    out = '**Commands** (count, mean, p99):\n' + '\n'.join(
+        '`{}` {}, {:.1f} ms, {:.1f} ms'.format(
+            labels['command'],
+            histogram.count,
+            histogram.sum / histogram.count * 1000,
+            histogram.quantile(0.99) * 1000,
+        )
+        for labels, histogram in commands
+    )
+    out += '\n**SQL statements by total time** (total, count):\n' + '\n'.join(
+        '`{:.60}` {:.0f} ms, {}'.format(labels['statement'].replace('`', ''), histogram.sum * 1000, histogram.count)
+        for labels, histogram in statements
+    )
+    out += '\n**DM queue depth:** {}'.format(santabot.delivery.queue_depth)
+    out += '\n**Command queue depth:** {} ({} rejected), busiest: {}'.format(
+        bot.dispatcher.pending,
+        bot.dispatcher.rejected,
+        ', '.join('{} ({})'.format(key, depth) for key, depth in bot.dispatcher.busiest(3)),
+    )
+    out += '\n**Database commits:** {} for {} writes'.format(santabot.db.commits, santabot.db.writes)
+    if cache is not None:
+        out += '\n**Server cache:** {} hits, {} misses'.format(cache.hits, cache.misses)
+
+    if len(loop_lag) > 0:
+        out += '\n**Event loop lag:** p99 under {:.1f} ms'.format(loop_lag[0][1].quantile(0.99) * 1000)
+
+    return out
+
+
+@bot.command(
+    'logs',
+    description='Get the recent log events of this server via DM.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+    is_hidden=True,
+)
+def cmd_logs(message, data):
+    # type: (discord.Message, str) -> str
+
+    count = int(data) if re.fullmatch(r'[0-9]+', data) else 50
+    events = santabot.logs.ring.dump(min(count, 500), server_id=message.server.id)
+
+    if len(events) == 0:
+        return 'There are no recent log events for this server.'
+
+    # One JSON object per line, every message in a code block of its own
+    messages = [
+        '```\n{}\n```'.format(x)
+        for x in split_message('\n'.join(json.dumps(x, default=str) for x in events), DiscordBot.MESSAGE_LIMIT - 8)
+    ]
+
+    santabot.delivery.submit(
+        message.server.id,
+        'logs',
+        [(message.author, x) for x in messages],
+        track=False,
+        interactive=True,
+    )
+
+    return '{} log events sent via DM.'.format(len(events))
+
+
+@bot.command(
+    'profile',
+    description='Profile the bot for the given number of seconds and get the slowest functions via DM.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    is_hidden=True,
+)
+def cmd_profile(message, data):
+    # type: (discord.Message, str) -> str
+
+    # Slows down every server of this shard while it runs, so server permissions are not enough
+    if message.author.id not in OWNER_IDS:
+        return 'Only the owners of the bot can profile it.'
+
+    if santabot.profiler is not None:
+        return 'A profile is already being captured.'
+
+    seconds = min(int(data), PROFILE_MAX_SECONDS) if re.fullmatch(r'[0-9]+', data) else 10
+    if seconds == 0:
+        return 'Profile for at least one second.'
+
+    # Everything running on the event loop is captured, command handlers, deliveries and database callbacks alike
+    capture = santabot.profiler = cProfile.Profile()
+    capture.enable()
+    asyncio.get_event_loop().call_later(seconds, finish_profile, capture, message.author)
+
+    return 'Profiling for {} seconds, the results will be sent via DM.'.format(seconds)
+
+
+def finish_profile(capture, user, count=15):
+    # type: (cProfile.Profile, discord.User, int) -> None
+
+    capture.disable()
+    if santabot.profiler is capture:
+        santabot.profiler = None
+
+    path = PROFILE_FILE.format(shard=SHARD_ID, time=int(time.time()))
+    capture.dump_stats(path)
+
+    # Functions by the time spent in them, not counting the functions they called. The event loop waiting
+    # for something to happen is idle time, not work.
+    stats = pstats.Stats(capture).stats  # type: typing.Dict[typing.Tuple[str, int, str], typing.Tuple]
+    idle = {key for key in stats if key[0] == '~' and any(x in key[2] for x in ('epoll', 'kqueue', 'select.'))}
+    slowest = sorted((x for x in stats.items() if x[0] not in idle), key=lambda x: -x[1][2])[:count]
+
+    out = 'Profile written to `{}`, the event loop was idle for {:.0f} ms. '.format(
+        path,
+        sum(stats[key][2] for key in idle) * 1000,
+    )
+    out += 'Slowest functions (own time, with calls, call count):\n'
+    out += '\n'.join(
+        '`{}:{}({})` {:.1f} ms, {:.1f} ms, {}'.format(
+            os.path.basename(filename),
+            line,
+            function,
+            own * 1000,
+            total * 1000,
+            calls,
+        )[:120]
+        for (filename, line, function), (_, calls, own, total, _) in slowest
+    )
+
+    log.info('captured profile', extra={'user_id': user.id, 'path': path})
+    santabot.delivery.submit('', 'profile', [(user, out)], track=False, interactive=True)
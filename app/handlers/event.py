@@ -0,0 +1,508 @@
+import calendar
+import datetime
+import discord
+import re
+import time
+import typing
+
+import santabot
+
+from assignment import AssignmentError, assign, exclude_pairs
+from discord_wrapper import DiscordBot, parse_id, split_message
+from handlers.participant import info_message
+from santabot import DISCORD_USER_ID_REGEX, MANAGEMENT_PERMISSIONS, PREFIX, REMINDER_INTERVAL, SCHEDULE_HORIZON, \
+    STATE_MESSAGES, bot, server_bind
+from storage import Context
+
+
+def mentioned_users(message):
+    # type: (discord.Message) -> typing.List[str]
+
+    # Mentioned users and all members of the mentioned roles, without bots
+    role_ids = {role.id for role in message.role_mentions}
+    members = list(message.mentions)
+
+    if len(role_ids) > 0:
+        members += [
+            member for member in message.server.members
+            if any(role.id in role_ids for role in member.roles)
+        ]
+
+    return sorted({member.id for member in members if not member.bot})
+
+
+def gift_message(gift):
+    # type: (str) -> str
+
+    if gift == '':
+        return 'Unfortunately, your Secret Santa did not provide a gift :('
+    else:
+        return 'Here is your gift from a Secret Santa!\n{}'.format(gift)
+
+
+@bot.command(
+    'start',
+    description='Start a new event.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'none'})
+async def cmd_start(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    if not await santabot.db.start_event(message.server.id, data):
+        return 'A Secret Santa event has already been started on this server.'
+
+    return 'A Secret Santa event was successfully started!'
+
+
+@bot.command(
+    'reset',
+    description='Reset all Secret Santa data for this server.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind()
+async def cmd_reset(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    # Finished events stay available through the "history" command, others are simply deleted
+    archived = ctx.state == 'distributed' and await santabot.db.archive_event(message.server.id)
+    if not archived:
+        await santabot.db.reset_event(message.server.id)
+
+    santabot.scheduler.forget(message.server.id)
+
+    if archived:
+        return ('All Secret Santa data for this server has been reset, the finished event was archived '
+                'without its gifts. Use `{}history` to look back at it.').format(PREFIX)
+
+    return 'All Secret Santa data for this server has been reset.'
+
+
+@bot.command(
+    'enroll',
+    description='Add the mentioned users and all members of the mentioned roles to the event.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'collecting'}, {'counts'})
+async def cmd_enroll(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    user_ids = mentioned_users(message)
+
+    if len(user_ids) == 0:
+        return 'Mention the users or roles to enroll.'
+
+    # Commands of a server run one at a time, the difference of the counts is exactly this command's doing
+    await santabot.db.add_recipients(message.server.id, user_ids)
+    after = await santabot.db.get_context(message.server.id, message.author.id, {'counts'})
+
+    return '{} users were enrolled, {} are taking part now.'.format(
+        after.participants - ctx.participants,
+        after.participants,
+    )
+
+
+@bot.command(
+    'unenroll',
+    description='Remove the mentioned users and all members of the mentioned roles from the event.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'collecting'}, {'counts'})
+async def cmd_unenroll(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    user_ids = mentioned_users(message)
+
+    if len(user_ids) == 0:
+        return 'Mention the users or roles to remove.'
+
+    await santabot.db.remove_recipients(message.server.id, user_ids)
+    after = await santabot.db.get_context(message.server.id, message.author.id, {'counts'})
+
+    return '{} users were removed, {} are taking part now.'.format(
+        ctx.participants - after.participants,
+        after.participants,
+    )
+
+
+async def distribute(server_id, budget, excluded, attempts=3):
+    # type: (str, str, typing.Set[typing.Tuple[str, str]], int) -> str
+
+    # A leave given via DM runs on the first shard and can commit while the participants are paired up on this
+    # one. The assignment is then rejected as stale, and made again with the participants as they are now.
+    for _ in range(attempts):
+        res = await santabot.db.get_recipient_ids(server_id)
+
+        if len(res) < 2:
+            return 'There has to be at least 2 users taking part in the Secret Santa event.'
+
+        try:
+            pairs = assign(res, excluded)
+        except AssignmentError:
+            return 'Could not assign everyone a recipient without pairing up the specified users, try fewer exclusions.'
+
+        if await santabot.db.assign(server_id, pairs):
+            break
+
+        ctx = await santabot.db.get_context(server_id, '0')
+
+        if ctx.state not in ('collecting', 'closed'):
+            return STATE_MESSAGES.get(ctx.state, STATE_MESSAGES['_'])
+    else:
+        return 'People kept joining or leaving while the recipients were assigned, please try again.'
+
+    santabot.users.prefetch(server_id, pairs.values())
+
+    # Wishes are streamed along with the pairs instead of being loaded for the whole server at once
+    job = santabot.delivery.submit(server_id, 'assignments', [])
+    async for chunk in santabot.db.iter_assignments(server_id):
+        santabot.delivery.extend(job, [
+            (discord.User(id=sender_id), info_message(recipient_id, wish, budget))
+            for sender_id, recipient_id, wish in chunk
+        ])
+
+    return '{} secret Santas were assigned respective gift recipients! Check your DMs.'.format(len(pairs))
+
+
+async def send_gifts(server_id):
+    # type: (str) -> str
+
+    # Gifts which were already delivered by an earlier send are not sent again. Every chunk is
+    # handed to the outbox worker as soon as it is queued, gift bodies are never all in memory at once
+    async for chunk in santabot.db.iter_gifts(server_id):
+        await santabot.db.queue_messages(server_id, 'gift', [
+            (recipient_id, gift_message(gift))
+            for recipient_id, gift in chunk
+        ])
+        santabot.outbox.wake()
+
+    counts = await santabot.db.count_messages(server_id, 'gift')
+
+    return 'Sending gifts to {} users, {} already have theirs! Use `{}deliveries` to follow the progress.'.format(
+        counts.get('pending', 0),
+        counts.get('sent', 0),
+        PREFIX,
+    )
+
+
+@bot.command(
+    'assign',
+    description='Assign everyone their secret gift recipient (couples who should not draw each other: '
+                '`@a @b, @c @d`).',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'collecting', 'closed'})
+async def cmd_assign(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    # Mentions separated by commas form groups (e.g. couples) whose members should not draw each other
+    excluded = exclude_pairs(
+        DISCORD_USER_ID_REGEX.findall(group.replace('!', ''))
+        for group in data.split(',')
+    )
+
+    return await distribute(message.server.id, ctx.budget, excluded)
+
+
+@bot.command(
+    'send',
+    description='Send everyone (or the mentioned users and roles) their gifts.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'distributed'})
+async def cmd_send(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    if data == '':
+        return await send_gifts(message.server.id)
+
+    recipient_ids = mentioned_users(message)
+
+    if len(recipient_ids) == 0:
+        return 'Invalid target user ID.'
+
+    res = await santabot.db.get_gifts(message.server.id, recipient_ids)
+
+    if len(res) < 1:
+        return "Requested users didn't take part in this Secret Santa event."
+
+    await santabot.db.queue_messages(message.server.id, 'gift', [
+        (recipient_id, gift_message(gift))
+        for recipient_id, gift in res
+    ], resend=True)
+    santabot.outbox.wake()
+
+    if len(res) == 1 and len(recipient_ids) == 1:
+        return 'Gift sent to the requested user.'
+
+    return 'Gifts sent to {} of the {} requested users, the others did not take part.'.format(
+        len(res),
+        len(recipient_ids),
+    )
+
+
+def reminder_message(server_id, recipient_id):
+    # type: (str, str) -> str
+
+    return ('Your gift for <@{recipient}> has not been submitted yet! Send it to the bot in a direct message: '
+            '```{prefix}submit {server} <gift>```').format(recipient=recipient_id, prefix=PREFIX, server=server_id)
+
+
+async def send_reminders(server_id):
+    # type: (str) -> int
+
+    # Reminders go through the outbox, which sends them at the pace of the delivery scheduler. Whoever was
+    # reminded within REMINDER_INTERVAL is skipped, so running this again only reaches the others.
+    now = int(time.time())
+    count = 0
+
+    async for chunk in santabot.db.iter_missing_gifts(server_id, now - REMINDER_INTERVAL):
+        await santabot.db.queue_messages(server_id, 'reminder', [
+            (sender_id, reminder_message(server_id, recipient_id))
+            for sender_id, recipient_id in chunk
+        ], resend=True)
+        await santabot.db.set_reminded(server_id, [sender_id for sender_id, _ in chunk], now)
+        santabot.outbox.wake()
+
+        count += len(chunk)
+
+    return count
+
+
+@bot.command(
+    'remind',
+    description='Remind everyone without a gift via DM.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'distributed'}, {'counts'})
+async def cmd_remind(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    count = await send_reminders(message.server.id)
+    # Everyone taking part is a sender once the recipients are assigned
+    skipped = ctx.participants - ctx.gifts - count
+
+    if count == 0 and skipped == 0:
+        return 'Everyone has submitted their gift already!'
+
+    return 'Reminding {} users of their gift, {} were already reminded in the last {} hours.'.format(
+        count,
+        skipped,
+        REMINDER_INTERVAL // 3600,
+    )
+
+
+async def scheduled_state(server_id, allowed_states):
+    # type: (str, typing.Set[str]) -> typing.Tuple[typing.Optional[str], Context]
+
+    # What server_bind does for commands: the message to give up with if the event is in another state
+    ctx = await santabot.db.get_context(server_id, '0')
+
+    if ctx.budget == '':
+        ctx.budget = 'not set'
+
+    if ctx.state in allowed_states:
+        return None, ctx
+
+    return STATE_MESSAGES.get(ctx.state, STATE_MESSAGES['_']), ctx
+
+
+@santabot.scheduler.action('close')
+async def action_close(server_id):
+    # type: (str) -> str
+
+    if not await santabot.db.close_event(server_id):
+        error, _ = await scheduled_state(server_id, set())
+        return error
+
+    return 'Joining and leaving the event is closed now.'
+
+
+@santabot.scheduler.action('assign')
+async def action_assign(server_id):
+    # type: (str) -> str
+
+    error, ctx = await scheduled_state(server_id, {'collecting', 'closed'})
+    if error is not None:
+        return error
+
+    return await distribute(server_id, ctx.budget, set())
+
+
+@santabot.scheduler.action('send')
+async def action_send(server_id):
+    # type: (str) -> str
+
+    error, _ = await scheduled_state(server_id, {'distributed'})
+    if error is not None:
+        return error
+
+    return await send_gifts(server_id)
+
+
+@santabot.scheduler.action('remind')
+async def action_remind(server_id):
+    # type: (str) -> str
+
+    error, _ = await scheduled_state(server_id, {'distributed'})
+    if error is not None:
+        return error
+
+    return 'Reminding {} users of their gift.'.format(await send_reminders(server_id))
+
+
+def parse_time(data):
+    # type: (str) -> typing.Optional[int]
+
+    # Either a date and time in UTC, or a number of minutes, hours or days from now
+    relative = re.fullmatch(r'([0-9]+)([mhd])', data)
+    if relative is not None:
+        return int(time.time()) + int(relative.group(1)) * {'m': 60, 'h': 3600, 'd': 86400}[relative.group(2)]
+
+    try:
+        return calendar.timegm(datetime.datetime.strptime(data, '%Y-%m-%d %H:%M').timetuple())
+    except ValueError:
+        return None
+
+
+@bot.command(
+    'schedule',
+    description='Run `close`, `assign`, `remind` or `send` later: `close 2d`, `send 2024-12-24 18:00` (UTC), '
+                '`send off`.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'collecting', 'closed', 'distributed'})
+async def cmd_schedule(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    scheduler = santabot.scheduler
+
+    if data == '':
+        actions = sorted(scheduler.get(message.server.id).items(), key=lambda x: x[1][0])
+
+        if len(actions) == 0:
+            return 'No actions are scheduled on this server.'
+
+        return 'Scheduled actions:\n' + '\n'.join(
+            '`{}` on {} UTC'.format(action, datetime.datetime.utcfromtimestamp(run_at).strftime('%Y-%m-%d %H:%M'))
+            for action, (run_at, _) in actions
+        )
+
+    action, _, when = data.partition(' ')
+
+    if action not in scheduler.actions:
+        return 'Unknown action, use one of {}.'.format(', '.join('`{}`'.format(x) for x in sorted(scheduler.actions)))
+
+    if when == 'off':
+        if not await scheduler.cancel(message.server.id, action):
+            return '`{}` was not scheduled.'.format(action)
+
+        return '`{}` will no longer run by itself.'.format(action)
+
+    run_at = parse_time(when.strip())
+
+    if run_at is None:
+        return 'Invalid time, use e.g. `2024-12-24 18:00` (UTC), `90m`, `12h` or `3d`.'
+    if run_at <= time.time():
+        return 'This time has already passed.'
+    # Also keeps the time within what the database and datetime can hold
+    if run_at > time.time() + SCHEDULE_HORIZON:
+        return 'Actions can be scheduled at most a year ahead.'
+
+    await scheduler.add(message.server.id, action, run_at, message.channel.id)
+
+    return '`{}` will run on {} UTC, the result will be posted here.'.format(
+        action,
+        datetime.datetime.utcfromtimestamp(run_at).strftime('%Y-%m-%d %H:%M'),
+    )
+
+
+@bot.command(
+    'deliveries',
+    description='Show the progress of the recent assignment and gift deliveries.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+async def cmd_deliveries(message, data):
+    # type: (discord.Message, str) -> str
+
+    jobs = santabot.delivery.progress(message.server.id)
+    gifts = await santabot.db.count_messages(message.server.id, 'gift')
+
+    if len(jobs) == 0 and len(gifts) == 0:
+        return 'No deliveries were made on this server recently.'
+
+    out = 'Recent deliveries:\n' + '\n'.join(job.describe() for job in jobs)
+
+    if len(gifts) > 0:
+        out += '\nGifts: {} delivered, {} failed, {} pending.'.format(
+            gifts.get('sent', 0),
+            gifts.get('failed', 0),
+            gifts.get('pending', 0),
+        )
+
+    return out
+
+
+@bot.command(
+    'history',
+    description='List the archived events of this server, or get who gifted whom in one of them via DM.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+async def cmd_history(message, data):
+    # type: (discord.Message, str) -> str
+
+    if data == '':
+        res = await santabot.db.get_archived_events(message.server.id, 10)
+
+        if len(res) == 0:
+            return 'There are no archived events on this server.'
+
+        return 'Archived events:\n' + '\n'.join(
+            '`{}` archived on {}, {} participants, {} gifts submitted, budget {}.'.format(
+                event_id,
+                datetime.datetime.utcfromtimestamp(archived_at).strftime('%Y-%m-%d'),
+                participants,
+                gifts,
+                'not set' if budget == '' else budget,
+            )
+            for event_id, archived_at, state, budget, participants, gifts in res
+        )
+
+    event_id = parse_id(data)
+    if event_id is None:
+        return 'Invalid archived event ID.'
+
+    event = await santabot.db.get_archived_event(message.server.id, int(event_id))
+    if event is None:
+        return 'There is no archived event with this ID on this server.'
+
+    lines = [
+        '<@{}> \u2192 {}{}'.format(
+            x['user_id'],
+            'nobody' if x['recipient_id'] is None else '<@{}>'.format(x['recipient_id']),
+            ' (gift submitted)' if x['submitted'] else '',
+        )
+        for x in event
+    ]
+
+    messages = split_message('Archived event {}:\n'.format(event_id) + '\n'.join(lines), DiscordBot.MESSAGE_LIMIT)
+
+    santabot.delivery.submit(
+        message.server.id,
+        'history',
+        [(message.author, x) for x in messages],
+        track=False,
+        interactive=True,
+    )
+
+    return 'Archived event sent via DM.'
@@ -0,0 +1,70 @@
+import discord
+
+from santabot import DESCRIPTION, PREFIX, bot
+
+
+@bot.command(
+    'howto',
+    description='Displays a simple how-to for the Secret Santa bot.',
+)
+def cmd_howto(*_):
+    # type: (...) -> str
+
+    return ('Here is a short how-to for the Secret Santa bot:\n'
+            '**Join the Secret Santa event**\n'
+            '```{prefix}join <wish>```'
+            'where `wish` (optional) describes what you would like to receive as a gift.\n\n'
+            '**Change your wish**\n'
+            '```{prefix}wish <wish>```\n'
+            'If you want, you can set or update your wishes via DM with the bot, if you don\'t want '
+            'others to know what you want:'
+            '```{prefix}wish 123456789012345678 I want a big cat plushie```'
+            'where `123456789012345678` is the server\'s numeric identifier '
+            '(use the `{prefix}id` command in the server to view it).\n\n'
+            '**Leave the Secret Santa event**\n'
+            '```{prefix}leave```\n'
+            '**Find out who is your secret gift recipient** (answer comes via DM from bot):\n'
+            '```{prefix}who```\n'
+            '**Submit your gift** (DM the bot):\n'
+            '```{prefix}submit 123456789012345678 Here is you Steam code: ABCDE-12345```'
+            'where `123456789012345678` is the server\'s numeric identifier '
+            '(use the `{prefix}id` command in the server to view it), '
+            'followed by the gift itself (say some kind words too, why not).\n\n').format(prefix=PREFIX)
+
+
+@bot.command(
+    'help',
+    description='Displays this help message.',
+)
+def cmd_help(*_):
+    # type: (...) -> str
+
+    empty = discord.Permissions.none()
+
+    out = '{}\n\nAvailable commands:\n'.format(DESCRIPTION)
+    out += '\n'.join([
+        '`{}{:6}{}` `{}` `{}`\t{}{}'.format(
+            PREFIX,
+            key,
+            chr(0),
+            'S' if value.can_run_server else '-',
+            'D' if value.can_run_direct else '-',
+            value.description,
+            ' \\*' if value.required_permissions > empty else '',
+        )
+        for key, value in bot.commands.items()
+        if not value.is_hidden
+    ])
+    out += '\n\n`S` — command can be used in a server, `D` — command can be used via direct messages.'
+    return out
+
+
+@bot.command(
+    'squee',
+    description='Show credits.',
+    is_hidden=True,
+)
+def cmd_squee(*_):
+    # type: (...) -> str
+
+    return 'Bot crafted with love by Foster Snowhill (<@299908539940601856>) :heart:'
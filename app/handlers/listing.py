@@ -0,0 +1,115 @@
+import discord
+import re
+import typing
+
+import santabot
+
+from santabot import MANAGEMENT_PERMISSIONS, PREFIX, bot, server_bind
+from storage import Context
+
+
+# Users read per page. Pages end early if the names do not fit into a single message.
+PAGE_SIZE = 50
+MESSAGE_LIMIT = 1800
+
+MARKDOWN_REGEX = re.compile(r'([\\`*_~|<>])')
+
+
+def parse_cursor(data):
+    # type: (str) -> typing.Optional[str]
+
+    # Cursors are the hexadecimal ID of the last user of the previous page, pages carry on right after it
+    if data == '':
+        return '0'
+
+    try:
+        after = int(data, 16)
+    except ValueError:
+        return None
+
+    # IDs are stored as signed 64-bit integers
+    if not 0 <= after < 2 ** 63:
+        return None
+
+    return str(after)
+
+
+def render_page(server, title, user_ids, more, command):
+    # type: (discord.Server, str, typing.List[str], bool, str) -> str
+
+    # Names instead of mentions, so that listing users does not notify every one of them
+    out = title
+
+    for i, user_id in enumerate(user_ids):
+        member = server.get_member(user_id)
+        line = '\n`{}` {}'.format(user_id, '(left the server)' if member is None else
+                                  MARKDOWN_REGEX.sub(r'\\\1', member.display_name))
+
+        # Every page lists at least one user, so that the next one starts further on
+        if i > 0 and len(out) + len(line) > MESSAGE_LIMIT:
+            user_ids, more = user_ids[:i], True
+            break
+
+        out += line
+
+    if more:
+        out += '\nNext page: `{}{} {:x}`'.format(PREFIX, command, int(user_ids[-1]))
+
+    return out
+
+
+@bot.command(
+    'list',
+    description='List everyone taking part, a page at a time.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'collecting', 'closed', 'distributed'}, {'counts'})
+async def cmd_list(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    after = parse_cursor(data.strip())
+    if after is None:
+        return 'Invalid page, use the command given at the end of the previous one.'
+
+    # One more than fits on the page tells whether there is a next one
+    user_ids = await santabot.db.get_recipient_page(message.server.id, after, PAGE_SIZE + 1)
+
+    if len(user_ids) == 0:
+        return 'Nobody is taking part in the event.' if after == '0' else 'There are no more participants.'
+
+    return render_page(
+        message.server,
+        '{} users are taking part:'.format(ctx.participants),
+        user_ids[:PAGE_SIZE],
+        len(user_ids) > PAGE_SIZE,
+        'list',
+    )
+
+
+@bot.command(
+    'pending',
+    description='List everyone without a gift, a page at a time.',
+    required_permissions=MANAGEMENT_PERMISSIONS,
+    can_run_direct=False,
+)
+@server_bind({'distributed'}, {'counts'})
+async def cmd_pending(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    after = parse_cursor(data.strip())
+    if after is None:
+        return 'Invalid page, use the command given at the end of the previous one.'
+
+    user_ids = await santabot.db.get_missing_gift_page(message.server.id, after, PAGE_SIZE + 1)
+
+    if len(user_ids) == 0:
+        return 'Everyone has submitted their gift already!' if after == '0' else 'There are no more users without a gift.'
+
+    return render_page(
+        message.server,
+        '{} users have not submitted their gift yet:'.format(ctx.participants - ctx.gifts),
+        user_ids[:PAGE_SIZE],
+        len(user_ids) > PAGE_SIZE,
+        'pending',
+    )
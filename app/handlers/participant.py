@@ -0,0 +1,187 @@
+import discord
+import typing
+
+import santabot
+
+from santabot import STATE_MESSAGES, bot, server_bind
+from storage import Context
+
+
+def info_message(recipient_id, wish, budget):
+    # type: (str, str, str) -> typing.Callable[[], typing.Awaitable[str]]
+
+    # The recipient's name is looked up by the delivery worker, right before the message is sent
+    async def render():
+        # type: () -> str
+
+        recipient = await santabot.users.get_user(recipient_id)
+
+        return 'Your secret gift recipient is <@{}> ({}). The budget is {}. Their wish is: {}'.format(
+            recipient_id,
+            recipient.name,
+            budget,
+            'not set' if wish == '' else wish,
+        )
+
+    return render
+
+
+async def lost_race(message, otherwise):
+    # type: (discord.Message, str) -> str
+
+    # A join or leave changed nothing: either the event left "collecting" since the command checked, e.g. by
+    # an assign on another shard, or a racing command of the same user was first
+    ctx = await santabot.db.get_context(message.server.id, message.author.id)
+
+    if ctx.state != 'collecting':
+        return STATE_MESSAGES.get(ctx.state, STATE_MESSAGES['_'])
+
+    return otherwise
+
+
+@bot.command(
+    'join',
+    description='Join an ongoing event (and optionally specify your wishes).',
+    can_run_direct=False,
+    # Joins come in storms after an event is announced, the shared server limit would turn most of them away
+    rate_limits={'server': (50.0, 2000)},
+    exempt_limits=('server',),
+    can_overlap=True,
+)
+@server_bind({'collecting'}, {'participant'})
+async def cmd_join(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    # Only let through users with no records in "recipients"
+    if ctx.wish is not None:
+        return 'You have already joined this Secret Santa event.'
+
+    if not await santabot.db.add_recipient(message.server.id, message.author.id, data):
+        return await lost_race(message, 'You have already joined this Secret Santa event.')
+
+    return 'You have successfully joined the Secret Santa event!'
+
+
+@bot.command(
+    'leave',
+    description='Leave an ongoing event.',
+    can_overlap=True,
+)
+@server_bind({'collecting'}, {'participant'})
+async def cmd_leave(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    # Only let through users with a record in "recipients"
+    if ctx.wish is None:
+        return STATE_MESSAGES['not_part']
+
+    if not await santabot.db.remove_recipient(message.server.id, message.author.id):
+        return await lost_race(message, STATE_MESSAGES['not_part'])
+
+    return 'You have successfully left the Secret Santa event. See you again soon!'
+
+
+@bot.command(
+    'wish',
+    description='Update your wishes.',
+    can_overlap=True,
+)
+@server_bind({'collecting', 'closed', 'distributed'}, {'participant'})
+async def cmd_wish(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    # Only let through users with a record in "recipients"
+    if ctx.wish is None:
+        return STATE_MESSAGES['not_part']
+
+    await santabot.db.set_wish(message.server.id, message.author.id, data)
+
+    return 'Your wishes have been updated!'
+
+
+@bot.command(
+    'submit',
+    description='Submit your gift for the recipient (**please use direct messages**).',
+    can_run_server=False,
+    can_overlap=True,
+)
+@server_bind({'distributed'}, {'sender'})
+async def cmd_submit(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    # Only let through users with a record in "senders"
+    if ctx.recipient_id is None:
+        return STATE_MESSAGES['not_part']
+
+    await santabot.db.set_gift(message.server.id, message.author.id, data)
+
+    return 'Your gift for <@{}> on server with ID {} was successfully submitted!'.format(
+        ctx.recipient_id,
+        message.server.id
+    )
+
+
+@bot.command(
+    'who',
+    description='Find out who is your secret gift recipient (answered via direct messages).',
+    rate_limits={'user': (1 / 60, 2)},
+    can_overlap=True,
+)
+@server_bind({'distributed'}, {'assignment'})
+async def cmd_who(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    if ctx.recipient_id is None:
+        return STATE_MESSAGES['not_part']
+
+    santabot.delivery.submit(message.server.id, 'who', [
+        (message.author, info_message(ctx.recipient_id, ctx.recipient_wish, ctx.budget)),
+    ], track=False, interactive=True)
+
+    return 'Requested information sent via DM.'
+
+
+@bot.command(
+    'status',
+    description='Shows current event status and how many people are enrolled.',
+    rate_limits={'server': (1.0, 10)},
+    can_overlap=True,
+)
+@server_bind({'collecting', 'closed', 'distributed'}, {'counts'})
+async def cmd_status(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    if ctx.state == 'collecting':
+        state_printable = 'Waiting for users to join, so far {} are in the event. Budget is {}.'.format(
+            ctx.participants,
+            ctx.budget,
+        )
+    elif ctx.state == 'closed':
+        state_printable = ('Joining is closed, {} are taking part and will be assigned their recipients soon. '
+                           'Budget is {}.').format(
+            ctx.participants,
+            ctx.budget,
+        )
+    elif ctx.state == 'distributed':
+        state_printable = ('All Secret Santas were assigned respective gift recipients, {} are taking part '
+                           'and {} submitted their gift. Budget is {}.').format(
+            ctx.participants,
+            ctx.gifts,
+            ctx.budget,
+        )
+    else:
+        state_printable = 'Secret Santa is currently in an unknown state. Try resetting it.'
+
+    return state_printable
+
+
+@bot.command(
+    'id',
+    description='Shows the current server ID, can be used for interacting with the bot via direct messages.',
+    can_run_direct=False,
+)
+@server_bind()
+async def cmd_id(message, data, ctx):
+    # type: (discord.Message, str, Context) -> str
+
+    return 'This server\'s ID is {}.'.format(message.server.id)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Runs santabot as several shard processes sharing a single database and restarts the ones that crash.
+#
+# Usage: launcher.py [shards]
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import typing
+
+from database import Database
+from logs import Logging
+
+
+SHARDS = 2
+# Seconds to wait before restarting a crashed shard, doubled with every crash in a row
+RESTART_BACKOFF = 1.0
+RESTART_BACKOFF_MAX = 300.0
+# A shard that stayed up for this long is considered healthy again
+HEALTHY_UPTIME = 600.0
+
+log = logging.getLogger('launcher')
+
+
+def run_shard(shard_id, shard_count):
+    # type: (int, int) -> None
+
+    # Shard configuration is read by santabot on import
+    os.environ['SANTABOT_SHARD_ID'] = str(shard_id)
+    os.environ['SANTABOT_SHARD_COUNT'] = str(shard_count)
+
+    import santabot
+    santabot.run()
+
+
+class Shard:
+    def __init__(self, shard_id, shard_count):
+        # type: (int, int) -> None
+
+        self.id = shard_id
+        self.count = shard_count
+        self.process = None  # type: typing.Optional[multiprocessing.Process]
+        self.started = 0.0
+        self.crashes = 0
+        self.restart_at = 0.0
+
+    def start(self, context):
+        # type: (typing.Any) -> None
+
+        self.process = context.Process(target=run_shard, args=(self.id, self.count), name='santabot-{}'.format(self.id))
+        self.process.start()
+        self.started = time.monotonic()
+        log.info('started shard', extra={'shard_id': self.id, 'pid': self.process.pid})
+
+    def check(self, now):
+        # type: (float) -> None
+
+        if self.process is None or self.process.is_alive():
+            return
+
+        if now - self.started >= HEALTHY_UPTIME:
+            self.crashes = 0
+
+        delay = min(RESTART_BACKOFF * 2 ** self.crashes, RESTART_BACKOFF_MAX)
+        log.warning('shard exited', extra={'shard_id': self.id, 'exit_code': self.process.exitcode, 'restart_in': delay})
+
+        self.crashes += 1
+        self.restart_at = now + delay
+        self.process = None
+
+
+def main(shard_count):
+    # type: (int) -> None
+
+    # Migrations are applied once here, so that shards starting at the same time do not race each other
+    import santabot
+
+    if santabot.STORAGE == 'memory':
+        # Every process would keep its own copy of the events and overwrite the others' snapshots
+        sys.exit('Memory storage cannot be shared by shards, use santabot.py to run a single process.')
+
+    db = Database(santabot.DATABASE_FILE, archive_path=santabot.ARCHIVE_FILE)
+    asyncio.get_event_loop().run_until_complete(db.open(santabot.DATABASE_MIGRATIONS))
+    db.close()
+
+    context = multiprocessing.get_context('spawn')
+    shards = [Shard(i, shard_count) for i in range(shard_count)]
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for shard in shards:
+        shard.start(context)
+
+    while not stopping:
+        time.sleep(1.0)
+        now = time.monotonic()
+
+        for shard in shards:
+            shard.check(now)
+
+            if shard.process is None and now >= shard.restart_at and not stopping:
+                shard.start(context)
+
+    log.info('stopping shards', extra={'signal': stopping[0]})
+
+    for shard in shards:
+        if shard.process is not None:
+            shard.process.terminate()
+
+    for shard in shards:
+        if shard.process is not None:
+            shard.process.join()
+
+
+if __name__ == '__main__':
+    # The shards start logging of their own
+    logs = Logging()
+    logs.start()
+
+    try:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else SHARDS)
+    finally:
+        logs.stop()
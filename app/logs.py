@@ -0,0 +1,173 @@
+from collections import deque
+
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import typing
+
+from ratelimit import TokenBucket
+
+
+# Attributes every LogRecord has, anything else was passed in "extra" and becomes a field of the event
+RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'sampled'}
+
+QUEUE_SIZE = 10000
+RING_SIZE = 1000
+# Records per second written in full under load, beyond that one in SAMPLE is. Warnings always are.
+RATE = 200.0
+SAMPLE = 10
+
+
+def event(record):
+    # type: (logging.LogRecord) -> typing.Dict[str, typing.Any]
+
+    out = {
+        'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+        'level': record.levelname.lower(),
+        'logger': record.name,
+        'event': record.getMessage(),
+    }
+    out.update((key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES)
+
+    if getattr(record, 'sampled', None) is not None:
+        out['sampled'] = record.sampled
+
+    return out
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        # type: (logging.LogRecord) -> str
+
+        out = event(record)
+
+        if record.exc_text:
+            out['exception'] = record.exc_text
+
+        return json.dumps(out, default=str)
+
+
+class RingBufferHandler(logging.Handler):
+    # Keeps the most recent events in memory, so that they can be looked at without access to the log files
+
+    def __init__(self, size=RING_SIZE):
+        # type: (int) -> None
+
+        super().__init__()
+        self.events = deque(maxlen=size)  # type: typing.Deque[typing.Dict[str, typing.Any]]
+
+    def emit(self, record):
+        # type: (logging.LogRecord) -> None
+
+        self.events.append(event(record))
+
+    def dump(self, count, **fields):
+        # type: (int, **typing.Any) -> typing.List[typing.Dict[str, typing.Any]]
+
+        # The most recent events having all of the given fields, oldest first
+        out = []
+
+        for x in reversed(self.events):
+            if len(out) >= count:
+                break
+            if all(x.get(key) == value for key, value in fields.items()):
+                out.append(x)
+
+        out.reverse()
+        return out
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=RATE, sample=SAMPLE):
+        # type: (float, int) -> None
+
+        super().__init__()
+        self.bucket = TokenBucket(rate, rate)
+        self.sample = sample
+        self.dropped = 0
+        self._count = 0
+
+    def filter(self, record):
+        # type: (logging.LogRecord) -> bool
+
+        if record.levelno >= logging.WARNING or self.bucket.try_acquire():
+            return True
+
+        self._count += 1
+        if self._count % self.sample == 0:
+            record.sampled = self.sample
+            return True
+
+        self.dropped += 1
+        return False
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    # Never blocks: when the writer thread cannot keep up, records are dropped and counted instead
+
+    def __init__(self, q):
+        # type: (queue.Queue) -> None
+
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # type: (logging.LogRecord) -> logging.LogRecord
+
+        # Arguments and tracebacks can change once the call returns, they are rendered before queueing
+        if record.exc_info is not None:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+
+        record.msg, record.args, record.exc_info = record.getMessage(), None, None
+        return record
+
+    def enqueue(self, record):
+        # type: (logging.LogRecord) -> None
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class Logging:
+    # Records are written as JSON lines by a background thread, the event loop only puts them into a queue.
+    # All records also go into a ring buffer, whether they were sampled out of the output or not.
+
+    def __init__(self, stream=None, queue_size=QUEUE_SIZE, ring_size=RING_SIZE, rate=RATE, sample=SAMPLE):
+        # type: (typing.Optional[typing.TextIO], int, int, float, int) -> None
+
+        output = logging.StreamHandler(sys.stdout if stream is None else stream)
+        output.setFormatter(JsonFormatter())
+
+        self.ring = RingBufferHandler(ring_size)
+        self.sampling = SamplingFilter(rate, sample)
+        self.handler = QueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(self.sampling)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, output)
+
+    @property
+    def dropped(self):
+        # type: () -> int
+
+        return self.sampling.dropped + self.handler.dropped
+
+    def start(self, level=logging.INFO):
+        # type: (int) -> None
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.ring)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self):
+        # type: () -> None
+
+        root = logging.getLogger()
+        root.removeHandler(self.ring)
+        root.removeHandler(self.handler)
+        self.listener.stop()
@@ -0,0 +1,624 @@
+from collections import Counter
+
+import asyncio
+import concurrent.futures
+import heapq
+import json
+import logging
+import os
+import time
+import typing
+
+from storage import Context, Storage
+
+
+log = logging.getLogger(__name__)
+
+
+class MemoryStorage(Storage):
+    # Keeps all events in dictionaries, so commands never wait for the disk. Every change is an operation
+    # which is applied in memory and appended to a journal, flushed to disk by a background thread every
+    # JOURNAL_INTERVAL seconds. Every SNAPSHOT_INTERVAL seconds the whole state is written to a snapshot
+    # and the journal starts over. Opening loads the snapshot and replays the journal on top of it.
+    #
+    # Changes from the last JOURNAL_INTERVAL before a crash are lost. Unlike the SQLite database, the files
+    # cannot be shared by several processes, so this is meant for a single shard.
+
+    JOURNAL_INTERVAL = 0.1
+    SNAPSHOT_INTERVAL = 300.0
+    CHUNK = 500
+
+    def __init__(self, path, journal_interval=JOURNAL_INTERVAL, snapshot_interval=SNAPSHOT_INTERVAL):
+        # type: (str, float, float) -> None
+
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.journal_interval = journal_interval
+        self.snapshot_interval = snapshot_interval
+
+        # Server -> state, budget, gifts submitted and when it was assigned
+        self.servers = {}  # type: typing.Dict[str, typing.Dict[str, typing.Any]]
+        # Server -> recipient -> wish
+        self.recipients = {}  # type: typing.Dict[str, typing.Dict[str, str]]
+        # Server -> sender -> [recipient, gift]
+        self.senders = {}  # type: typing.Dict[str, typing.Dict[str, typing.List[str]]]
+        # Server -> sender -> when they were last reminded to submit their gift
+        self.reminded = {}  # type: typing.Dict[str, typing.Dict[str, int]]
+        # Server -> "kind user" -> [content, state, attempts]
+        self.outbox = {}  # type: typing.Dict[str, typing.Dict[str, typing.List[typing.Any]]]
+        # Server -> action -> [run at, channel]
+        self.schedule = {}  # type: typing.Dict[str, typing.Dict[str, typing.List[typing.Any]]]
+        self.archive = []  # type: typing.List[typing.Dict[str, typing.Any]]
+
+        self._journal = []  # type: typing.List[str]
+        self._file = None  # type: typing.Optional[typing.TextIO]
+        self._flush_handle = None  # type: typing.Optional[asyncio.Handle]
+        self._snapshots = None  # type: typing.Optional[asyncio.Future]
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory-writer')
+
+    # PERSISTENCE
+
+    def _state(self):
+        # type: () -> str
+
+        return json.dumps({
+            'servers': self.servers,
+            'recipients': self.recipients,
+            'senders': self.senders,
+            'reminded': self.reminded,
+            'outbox': self.outbox,
+            'schedule': self.schedule,
+            'archive': self.archive,
+        })
+
+    def _write_snapshot(self, state):
+        # type: (str) -> None
+
+        # Written next to the target and renamed, a crash leaves either the old snapshot or the new one.
+        # Everything in the journal so far is part of the snapshot, so it starts over.
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(state)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(self.path + '.tmp', self.path)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, 'w')
+
+    def _write_journal(self, lines):
+        # type: (typing.List[str]) -> None
+
+        self._file.write(''.join(line + '\n' for line in lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _recover(self):
+        # type: () -> None
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+
+            self.servers = state['servers']
+            self.recipients = state['recipients']
+            self.senders = state['senders']
+            self.reminded = state.get('reminded', {})
+            self.outbox = state['outbox']
+            self.schedule = state.get('schedule', {})
+            self.archive = state['archive']
+
+        replayed = 0
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    # The last line is incomplete if the process died while writing it
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break
+
+                    self._apply(op)
+                    replayed += 1
+
+        # Starting from a fresh snapshot, nothing is ever appended after a torn line
+        self._write_snapshot(self._state())
+        log.info('recovered memory storage', extra={'path': self.path, 'replayed': replayed})
+
+    def _flush(self):
+        # type: () -> None
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        lines, self._journal = self._journal, []
+        if len(lines) == 0:
+            return
+
+        self.commits += 1
+        asyncio.get_event_loop().run_in_executor(self._writer, self._write_journal, lines)
+
+    async def snapshot(self):
+        # type: () -> None
+
+        # The journal lines written before are included in the state, those written after go to the new journal
+        self._flush()
+        await asyncio.get_event_loop().run_in_executor(self._writer, self._write_snapshot, self._state())
+
+    async def _snapshot_periodically(self):
+        # type: () -> None
+
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            try:
+                await self.snapshot()
+            except OSError:
+                log.exception('could not write snapshot', extra={'path': self.path})
+
+    async def open(self, migrations_directory=None):
+        # type: (typing.Optional[str]) -> None
+
+        await asyncio.get_event_loop().run_in_executor(self._writer, self._recover)
+        self._snapshots = asyncio.ensure_future(self._snapshot_periodically())
+
+    def close(self):
+        # type: () -> None
+
+        if self._snapshots is not None:
+            self._snapshots.cancel()
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        # The loop might not be running anymore, the last snapshot is written right here
+        self._writer.shutdown()
+        self._journal = []
+        self._write_snapshot(self._state())
+        self._file.close()
+        self._file = None
+
+    # OPERATIONS
+
+    def _commit(self, *op):
+        # type: (*typing.Any) -> None
+
+        self._apply(op)
+        self.writes += 1
+        self._journal.append(json.dumps(op))
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.journal_interval, self._flush)
+
+    def _apply(self, op):
+        # type: (typing.Sequence) -> None
+
+        getattr(self, '_apply_' + op[0])(*op[1:])
+
+    def _apply_start(self, server_id, budget):
+        # type: (str, str) -> None
+
+        self.servers[server_id] = {'state': 'collecting', 'budget': budget, 'gifts': 0, 'distributed_at': None}
+        self.recipients[server_id] = {}
+        self.senders[server_id] = {}
+        self.outbox[server_id] = {}
+
+    def _apply_reset(self, server_id):
+        # type: (str) -> None
+
+        for table in (self.servers, self.recipients, self.senders, self.reminded, self.outbox, self.schedule):
+            table.pop(server_id, None)
+
+    def _apply_join(self, server_id, recipient_ids, wish):
+        # type: (str, typing.List[str], str) -> None
+
+        recipients = self.recipients.get(server_id)
+        if recipients is None:
+            return
+
+        for recipient_id in recipient_ids:
+            recipients.setdefault(recipient_id, wish)
+
+    def _apply_leave(self, server_id, recipient_ids):
+        # type: (str, typing.List[str]) -> None
+
+        recipients = self.recipients.get(server_id, {})
+
+        for recipient_id in recipient_ids:
+            recipients.pop(recipient_id, None)
+
+    def _apply_wish(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> None
+
+        recipients = self.recipients.get(server_id, {})
+
+        if recipient_id in recipients:
+            recipients[recipient_id] = wish
+
+    def _apply_close(self, server_id):
+        # type: (str) -> None
+
+        self.servers[server_id]['state'] = 'closed'
+
+    def _apply_assign(self, server_id, pairs, distributed_at):
+        # type: (str, typing.Dict[str, str], int) -> None
+
+        self.servers[server_id].update(state='distributed', distributed_at=distributed_at, gifts=0)
+        self.senders[server_id] = {sender_id: [recipient_id, ''] for sender_id, recipient_id in pairs.items()}
+
+    def _apply_gift(self, server_id, sender_id, gift):
+        # type: (str, str, str) -> None
+
+        sender = self.senders.get(server_id, {}).get(sender_id)
+        if sender is None:
+            return
+
+        self.servers[server_id]['gifts'] += (gift != '') - (sender[1] != '')
+        sender[1] = gift
+
+    def _apply_remind(self, server_id, sender_ids, reminded_at):
+        # type: (str, typing.List[str], int) -> None
+
+        reminded = self.reminded.setdefault(server_id, {})
+
+        for sender_id in sender_ids:
+            reminded[sender_id] = reminded_at
+
+    def _apply_queue(self, server_id, kind, messages, resend):
+        # type: (str, str, typing.List[typing.List[str]], bool) -> None
+
+        outbox = self.outbox.setdefault(server_id, {})
+
+        for user_id, content in messages:
+            key = '{} {}'.format(kind, user_id)
+            message = outbox.get(key)
+
+            if message is None:
+                outbox[key] = [content, 'pending', 0]
+            elif resend or message[1] != 'sent':
+                message[0], message[1] = content, 'pending'
+
+    def _apply_message(self, server_id, kind, user_id, state):
+        # type: (str, str, str, str) -> None
+
+        message = self.outbox.get(server_id, {}).get('{} {}'.format(kind, user_id))
+
+        if message is not None:
+            message[1] = state
+            message[2] += 1
+
+    def _apply_schedule(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        self.schedule.setdefault(server_id, {})[action] = [run_at, channel_id]
+
+    def _apply_unschedule(self, server_id, action, run_at):
+        # type: (str, str, typing.Optional[int]) -> None
+
+        actions = self.schedule.get(server_id, {})
+
+        if action in actions and run_at in (None, actions[action][0]):
+            del actions[action]
+            if len(actions) == 0:
+                del self.schedule[server_id]
+
+    def _apply_archive(self, server_id, event):
+        # type: (str, typing.Dict[str, typing.Any]) -> None
+
+        self.archive.append(event)
+        self._apply_reset(server_id)
+
+    # SERVERS
+
+    def _state_of(self, server_id):
+        # type: (str) -> str
+
+        return self.servers.get(server_id, {}).get('state', 'none')
+
+    async def get_context(self, server_id, user_id, parts=frozenset()):
+        # type: (str, str, typing.AbstractSet[str]) -> Context
+
+        server = self.servers.get(server_id)
+        if server is None:
+            return Context('none', '')
+
+        ctx = Context(server['state'], server['budget'])
+        recipients = self.recipients[server_id]
+
+        if 'counts' in parts:
+            ctx.participants = len(recipients)
+            ctx.gifts = server['gifts']
+
+        if 'participant' in parts:
+            ctx.wish = recipients.get(user_id)
+
+        sender = self.senders[server_id].get(user_id)
+        if sender is not None and ('sender' in parts or 'assignment' in parts):
+            ctx.recipient_id, ctx.gift = sender
+
+            if 'assignment' in parts:
+                ctx.recipient_wish = recipients.get(ctx.recipient_id)
+
+        return ctx
+
+    async def start_event(self, server_id, budget):
+        # type: (str, str) -> bool
+
+        if server_id in self.servers:
+            return False
+
+        self._commit('start', server_id, budget)
+        return True
+
+    async def reset_event(self, server_id):
+        # type: (str) -> None
+
+        self._commit('reset', server_id)
+
+    async def close_event(self, server_id):
+        # type: (str) -> bool
+
+        if self._state_of(server_id) != 'collecting':
+            return False
+
+        self._commit('close', server_id)
+        return True
+
+    async def assign(self, server_id, pairs):
+        # type: (str, typing.Dict[str, str]) -> bool
+
+        if self._state_of(server_id) not in ('collecting', 'closed'):
+            return False
+
+        recipients = self.recipients.get(server_id, {})
+        if len(recipients) != len(pairs) or any(sender_id not in recipients for sender_id in pairs):
+            return False
+
+        self._commit('assign', server_id, pairs, int(time.time()))
+        return True
+
+    # RECIPIENTS
+
+    async def get_recipient_ids(self, server_id):
+        # type: (str) -> typing.List[str]
+
+        return list(self.recipients.get(server_id, {}))
+
+    async def get_recipient_page(self, server_id, after, limit):
+        # type: (str, str, int) -> typing.List[str]
+
+        # Without an ordered index every page looks at all users of the server, which is fine for small ones
+        return heapq.nsmallest(limit, (
+            recipient_id for recipient_id in self.recipients.get(server_id, {}) if int(recipient_id) > int(after)
+        ), key=int)
+
+    async def add_recipient(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> bool
+
+        if self._state_of(server_id) != 'collecting' or recipient_id in self.recipients[server_id]:
+            return False
+
+        self._commit('join', server_id, [recipient_id], wish)
+        return True
+
+    async def add_recipients(self, server_id, recipient_ids):
+        # type: (str, typing.Iterable[str]) -> None
+
+        if self._state_of(server_id) == 'collecting':
+            self._commit('join', server_id, list(recipient_ids), '')
+
+    async def remove_recipient(self, server_id, recipient_id):
+        # type: (str, str) -> bool
+
+        if self._state_of(server_id) != 'collecting' or recipient_id not in self.recipients[server_id]:
+            return False
+
+        self._commit('leave', server_id, [recipient_id])
+        return True
+
+    async def remove_recipients(self, server_id, recipient_ids):
+        # type: (str, typing.Iterable[str]) -> None
+
+        if self._state_of(server_id) == 'collecting':
+            self._commit('leave', server_id, list(recipient_ids))
+
+    async def set_wish(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> None
+
+        self._commit('wish', server_id, recipient_id, wish)
+
+    # SENDERS
+
+    async def set_gift(self, server_id, sender_id, gift):
+        # type: (str, str, str) -> None
+
+        self._commit('gift', server_id, sender_id, gift)
+
+    async def get_gifts(self, server_id, recipient_ids):
+        # type: (str, typing.Sequence[str]) -> typing.List[typing.Tuple[str, str]]
+
+        wanted = set(recipient_ids)
+
+        return [
+            (recipient_id, gift)
+            for recipient_id, gift in self.senders.get(server_id, {}).values()
+            if recipient_id in wanted
+        ]
+
+    async def iter_assignments(self, server_id, chunk=CHUNK):
+        # type: (str, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str, str]]]
+
+        recipients = self.recipients.get(server_id, {})
+        senders = self.senders.get(server_id, {})
+        res = [
+            (sender_id, senders[sender_id][0], recipients[senders[sender_id][0]])
+            for sender_id in sorted(senders, key=int)
+            if senders[sender_id][0] in recipients
+        ]
+
+        for i in range(0, len(res), chunk):
+            yield res[i:i + chunk]
+
+    async def iter_gifts(self, server_id, chunk=CHUNK):
+        # type: (str, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str]]]
+
+        res = sorted(
+            ((recipient_id, gift) for recipient_id, gift in self.senders.get(server_id, {}).values()),
+            key=lambda x: int(x[0]),
+        )
+
+        for i in range(0, len(res), chunk):
+            yield res[i:i + chunk]
+
+    async def iter_missing_gifts(self, server_id, reminded_before, chunk=CHUNK):
+        # type: (str, int, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str]]]
+
+        reminded = self.reminded.get(server_id, {})
+        res = sorted(
+            (
+                (sender_id, recipient_id) for sender_id, (recipient_id, gift) in self.senders.get(server_id, {}).items()
+                if gift == '' and reminded.get(sender_id, 0) < reminded_before
+            ),
+            key=lambda x: int(x[0]),
+        )
+
+        for i in range(0, len(res), chunk):
+            yield res[i:i + chunk]
+
+    async def get_missing_gift_page(self, server_id, after, limit):
+        # type: (str, str, int) -> typing.List[str]
+
+        return heapq.nsmallest(limit, (
+            sender_id for sender_id, (_, gift) in self.senders.get(server_id, {}).items()
+            if gift == '' and int(sender_id) > int(after)
+        ), key=int)
+
+    async def set_reminded(self, server_id, sender_ids, reminded_at):
+        # type: (str, typing.Iterable[str], int) -> None
+
+        self._commit('remind', server_id, list(sender_ids), reminded_at)
+
+    # OUTBOX
+
+    async def queue_messages(self, server_id, kind, messages, resend=False):
+        # type: (str, str, typing.Sequence[typing.Tuple[str, str]], bool) -> None
+
+        self._commit('queue', server_id, kind, [list(x) for x in messages], resend)
+
+    async def get_pending_messages(self, after, limit, shard_id=0, shard_count=1):
+        # type: (typing.Tuple[str, str, str], int, int, int) -> typing.List[typing.Tuple[str, str, str, str]]
+
+        after_key = (int(after[0]), after[1], int(after[2]))
+        res = []
+
+        for server_id in sorted(self.outbox, key=int):
+            if (int(server_id) >> 22) % shard_count != shard_id or int(server_id) < after_key[0]:
+                continue
+
+            for key, (content, state, _) in self.outbox[server_id].items():
+                kind, user_id = key.split(' ')
+
+                if state == 'pending' and (int(server_id), kind, int(user_id)) > after_key:
+                    res.append((server_id, kind, user_id, content))
+
+            if len(res) >= limit:
+                break
+
+        res.sort(key=lambda x: (int(x[0]), x[1], int(x[2])))
+        return res[:limit]
+
+    async def set_message_state(self, server_id, kind, user_id, state):
+        # type: (str, str, str, str) -> None
+
+        self._commit('message', server_id, kind, user_id, state)
+
+    async def count_messages(self, server_id, kind):
+        # type: (str, str) -> typing.Dict[str, int]
+
+        prefix = kind + ' '
+
+        return dict(Counter(
+            state for key, (_, state, _) in self.outbox.get(server_id, {}).items() if key.startswith(prefix)
+        ))
+
+    # SCHEDULE
+
+    async def schedule_action(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        self._commit('schedule', server_id, action, run_at, channel_id)
+
+    async def unschedule_action(self, server_id, action, run_at=None):
+        # type: (str, str, typing.Optional[int]) -> None
+
+        self._commit('unschedule', server_id, action, run_at)
+
+    async def get_scheduled_actions(self, shard_id=0, shard_count=1):
+        # type: (int, int) -> typing.List[typing.Tuple[str, str, int, str]]
+
+        return [
+            (server_id, action, run_at, channel_id)
+            for server_id, actions in self.schedule.items() if (int(server_id) >> 22) % shard_count == shard_id
+            for action, (run_at, channel_id) in actions.items()
+        ]
+
+    # ARCHIVE
+
+    async def archive_event(self, server_id):
+        # type: (str) -> bool
+
+        server = self.servers.get(server_id)
+        if server is None:
+            return False
+
+        senders = self.senders[server_id]
+        self._commit('archive', server_id, {
+            'event_id': len(self.archive) + 1,
+            'server_id': server_id,
+            'archived_at': int(time.time()),
+            'state': server['state'],
+            'budget': server['budget'],
+            'participants': len(self.recipients[server_id]),
+            'gifts': server['gifts'],
+            'data': [
+                {
+                    'user_id': user_id,
+                    'wish': wish,
+                    'recipient_id': senders[user_id][0] if user_id in senders else None,
+                    'submitted': senders[user_id][1] != '' if user_id in senders else None,
+                }
+                for user_id, wish in self.recipients[server_id].items()
+            ],
+        })
+
+        return True
+
+    async def get_finished_events(self, before, shard_id=0, shard_count=1):
+        # type: (int, int, int) -> typing.List[str]
+
+        return [
+            server_id for server_id, server in self.servers.items()
+            if server['state'] == 'distributed' and server['distributed_at'] < before
+            and (int(server_id) >> 22) % shard_count == shard_id
+        ]
+
+    async def get_archived_events(self, server_id, limit):
+        # type: (str, int) -> typing.List[typing.Tuple[int, int, str, str, int, int]]
+
+        return [
+            (x['event_id'], x['archived_at'], x['state'], x['budget'], x['participants'], x['gifts'])
+            for x in reversed(self.archive) if x['server_id'] == server_id
+        ][:limit]
+
+    async def get_archived_event(self, server_id, event_id):
+        # type: (str, int) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]
+
+        for x in self.archive:
+            if x['server_id'] == server_id and x['event_id'] == event_id:
+                return x['data']
+
+        return None
@@ -0,0 +1,181 @@
+from collections import Counter
+
+import asyncio
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+import typing
+
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+log = logging.getLogger(__name__)
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        # type: (typing.Sequence[float]) -> None
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # type: (float) -> None
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # type: (float) -> float
+
+        # Upper bound of the bucket the quantile falls into, good enough for spotting trouble
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+        return 0.0
+
+
+class Metrics:
+    # Counters and histograms are plain dictionary updates under a lock, cheap enough to be always on.
+    # Gauges are functions evaluated when the metrics are read.
+
+    def __init__(self):
+        # type: () -> None
+
+        self.counters = Counter()  # type: typing.Counter[typing.Tuple[str, Labels]]
+        self.histograms = {}  # type: typing.Dict[typing.Tuple[str, Labels], Histogram]
+        self.gauges = {}  # type: typing.Dict[str, typing.Callable[[], float]]
+
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        # type: (str, float, **str) -> None
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        # type: (str, float, **str) -> None
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, function):
+        # type: (str, typing.Callable[[], float]) -> None
+
+        self.gauges[name] = function
+
+    def observe_query(self, sql, seconds):
+        # type: (str, float) -> None
+
+        # Statements become labels as they are, just on a single line
+        self.observe('santabot_sql_seconds', seconds, statement=WHITESPACE_REGEX.sub(' ', sql).strip())
+
+    def histogram_items(self, name):
+        # type: (str) -> typing.List[typing.Tuple[typing.Dict[str, str], Histogram]]
+
+        with self._lock:
+            return [(dict(labels), histogram) for (key, labels), histogram in self.histograms.items() if key == name]
+
+    def render(self):
+        # type: () -> str
+
+        # Prometheus text exposition format
+        lines = []
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda x: x[0])
+
+        for (name, labels), value in counters:
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+        for (name, labels), histogram in histograms:
+            cumulative = 0
+
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name,
+                    _labels(labels + (('le', '+Inf' if bound == float('inf') else repr(bound)),)),
+                    cumulative,
+                ))
+
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), histogram.count))
+
+        for name, function in sorted(self.gauges.items()):
+            lines.append('{} {}'.format(name, function()))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # type: (str) -> None
+
+        # Written next to the target and renamed, so that a scraper never sees a half-written file
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+
+        os.replace(path + '.tmp', path)
+
+
+def _labels(labels):
+    # type: (Labels) -> str
+
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ) + '}'
+
+
+async def measure_loop_lag(metrics, interval=1.0):
+    # type: (Metrics, float) -> None
+
+    # How late the loop wakes up from a sleep is how long some callback kept it busy
+    lag = [0.0]
+    metrics.gauge('santabot_loop_lag_last_seconds', lambda: lag[0])
+
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag[0] = max(0.0, time.perf_counter() - started - interval)
+        metrics.observe('santabot_loop_lag_seconds', lag[0])
+
+
+async def export_periodically(metrics, path, interval=15.0):
+    # type: (Metrics, str, float) -> None
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await loop.run_in_executor(None, metrics.write, path)
+        except OSError as e:
+            log.warning('could not export metrics', extra={'path': path, 'error': str(e)})
@@ -0,0 +1,53 @@
+import logging
+import os
+import re
+import sqlite3
+import typing
+
+
+MIGRATION_FILE_REGEX = re.compile(r'^(\d+)_\w+\.sql$')
+
+log = logging.getLogger(__name__)
+
+
+def load(directory):
+    # type: (str) -> typing.List[typing.Tuple[int, str, str]]
+
+    # Migrations are SQL files named "<version>_<description>.sql", applied in the order of their versions
+    migrations = []
+
+    for name in os.listdir(directory):
+        match = MIGRATION_FILE_REGEX.match(name)
+        if match is None:
+            continue
+
+        with open(os.path.join(directory, name), 'r') as f:
+            migrations.append((int(match.group(1)), name, f.read()))
+
+    migrations.sort()
+    return migrations
+
+
+def migrate(conn, directory):
+    # type: (sqlite3.Connection, str) -> typing.Tuple[int, int]
+
+    # The schema version is kept in SQLite's user_version, which is updated in the same transaction
+    # as the migration itself, so a failed migration leaves the database exactly as it was.
+    # Databases created from the unversioned schema have version 0, the first migration is a no-op for them.
+    initial = current = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    for version, name, script in load(directory):
+        if version <= current:
+            continue
+
+        try:
+            conn.executescript('BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;'.format(script, version))
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+        log.info('applied database migration', extra={'migration': name})
+        current = version
+
+    return initial, current
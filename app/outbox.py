@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import typing
+
+import discord
+
+from delivery import DeliveryScheduler
+from storage import Storage
+
+
+log = logging.getLogger(__name__)
+
+
+class Outbox:
+    # Drains the pending messages of the outbox table through the delivery scheduler in batches.
+    # A message stays pending until its delivery is final, so the table itself is the checkpoint: after
+    # a restart the worker simply carries on with whatever is still pending. Messages which were being
+    # sent when the process died are sent again, delivery is at least once.
+
+    BATCH = 500
+    # Seconds between scans, picks up messages queued by other processes
+    INTERVAL = 30.0
+
+    def __init__(self, db, delivery, shard_id=0, shard_count=1, batch=BATCH, interval=INTERVAL):
+        # type: (Storage, DeliveryScheduler, int, int, int, float) -> None
+
+        self.db = db
+        self.delivery = delivery
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.batch = batch
+        self.interval = interval
+
+        # Messages handed to the scheduler whose final state is not committed yet
+        self.in_flight = set()  # type: typing.Set[typing.Tuple[str, str, str]]
+
+        self._wakeup = None  # type: typing.Optional[asyncio.Event]
+
+    def wake(self):
+        # type: () -> None
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        # type: () -> None
+
+        self._wakeup = asyncio.Event()
+
+        while True:
+            self._wakeup.clear()
+
+            try:
+                await self.drain()
+            except Exception:
+                log.exception('outbox drain failed')
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self):
+        # type: () -> None
+
+        after = ('0', '', '0')
+
+        while True:
+            # Do not read further ahead than the scheduler can keep up with
+            while self.delivery.queue_depth >= self.batch:
+                await asyncio.sleep(0.1)
+
+            res = await self.db.get_pending_messages(after, self.batch, self.shard_id, self.shard_count)
+            if len(res) == 0:
+                return
+
+            after = res[-1][:3]
+
+            # Rows come ordered by server and kind, every run of them becomes one delivery job
+            messages = []  # type: typing.List[typing.Tuple[discord.User, str]]
+            for i, (server_id, kind, user_id, content) in enumerate(res):
+                if (server_id, kind, user_id) not in self.in_flight:
+                    self.in_flight.add((server_id, kind, user_id))
+                    messages.append((discord.User(id=user_id), content))
+
+                if i + 1 == len(res) or res[i + 1][:2] != (server_id, kind):
+                    if len(messages) > 0:
+                        self.delivery.submit(server_id, kind + 's', messages, on_result=self._on_result(server_id, kind))
+                    messages = []
+
+    def _on_result(self, server_id, kind):
+        # type: (str, str) -> typing.Callable[[discord.User, bool], None]
+
+        def on_result(destination, success):
+            # type: (discord.User, bool) -> None
+
+            asyncio.ensure_future(self._finish(server_id, kind, destination.id, success))
+
+        return on_result
+
+    async def _finish(self, server_id, kind, user_id, success):
+        # type: (str, str, str, bool) -> None
+
+        try:
+            await self.db.set_message_state(server_id, kind, user_id, 'sent' if success else 'failed')
+        finally:
+            # Only now a scan may see the message again, it is no longer pending
+            self.in_flight.discard((server_id, kind, user_id))
@@ -0,0 +1,134 @@
+from collections import Counter
+
+import asyncio
+import time
+import typing
+
+from cache import LRUCache
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        # type: (float, float, typing.Callable[[], float]) -> None
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        # type: () -> None
+
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        # type: (float) -> bool
+
+        self._refill()
+
+        if self.tokens < tokens:
+            return False
+
+        self.tokens -= tokens
+        return True
+
+    def delay(self, tokens=1):
+        # type: (float) -> float
+
+        # Seconds until the requested amount of tokens becomes available
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def penalize(self, seconds):
+        # type: (float) -> None
+
+        # Used when the remote side reports a rate limit hit: nothing is let through for the given time
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    async def acquire(self, tokens=1):
+        # type: (float) -> None
+
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+
+class Throttle:
+    # Token buckets per scope, where the scope is one of:
+    # "user" (per command author), "server" (per server, DMs share one bucket) and "global".
+    #
+    # Every command takes a token from the bot-wide buckets of its user, server and the bot, which all
+    # commands share, so cycling through commands does not get around them. Commands with limits of their
+    # own additionally take a token from buckets of their own. Commands can be exempt from scopes of the
+    # bot-wide buckets, e.g. joins after an announcement, which should then have a limit of their own instead.
+
+    SCOPES = ('user', 'server', 'global')
+    MAX_BUCKETS = 100000
+
+    def __init__(self, limits=None, max_buckets=MAX_BUCKETS):
+        # type: (typing.Optional[typing.Dict[str, typing.Tuple[float, float]]], int) -> None
+
+        self.limits = {} if limits is None else limits
+        self.enabled = True
+
+        self.allowed = Counter()  # type: typing.Counter[str]
+        self.throttled = Counter()  # type: typing.Counter[typing.Tuple[str, str]]
+
+        self._buckets = LRUCache(max_buckets)
+        self._warned = LRUCache(max_buckets)
+
+    def check(self, command, limits, user_id, server_id, exempt=()):
+        # type: (str, typing.Optional[typing.Dict[str, typing.Tuple[float, float]]], str, typing.Optional[str], typing.Iterable[str]) -> typing.Optional[typing.Tuple[str, str, str]]
+
+        # Returns None when the message may pass, otherwise the key of the bucket which ran out.
+        # Tokens are only taken when every bucket has one, so a rejected message costs nothing.
+        if not self.enabled:
+            return None
+
+        ids = {'user': user_id, 'server': server_id or '', 'global': ''}
+        # The bot-wide buckets have no command in their key
+        wanted = [
+            ('', scope, self.limits[scope]) for scope in Throttle.SCOPES if scope in self.limits and scope not in exempt
+        ]
+        if limits is not None:
+            wanted += [(command, scope, limits[scope]) for scope in Throttle.SCOPES if scope in limits]
+
+        buckets = []
+
+        for bucket_command, scope, limit in wanted:
+            key = (bucket_command, scope, ids[scope])
+            bucket = self._buckets.get(key)
+
+            if bucket is None:
+                bucket = TokenBucket(*limit)
+                self._buckets.put(key, bucket)
+
+            if bucket.delay() > 0:
+                self.throttled[command, scope] += 1
+                return key
+
+            buckets.append((key, bucket))
+
+        for key, bucket in buckets:
+            bucket.try_acquire()
+            self._warned.pop(key + (user_id,))
+
+        self.allowed[command] += 1
+        return None
+
+    def should_warn(self, key, user_id):
+        # type: (typing.Tuple[str, str, str], str) -> bool
+
+        # Every user gets a reply to their first rejection by a bucket, their further ones in a row are dropped
+        # silently. Warnings are per user, so a shared bucket running out does not silence everyone behind it.
+        key += (user_id,)
+
+        if key in self._warned:
+            return False
+
+        self._warned.put(key, True)
+        return True
@@ -1,24 +1,56 @@
 #!/usr/bin/env python3
 
 import asyncio
-import random
+import cProfile
+import functools
+import logging
+import os
 import re
-import sqlite3
+import sys
+import time
 import typing
 
-from discord_wrapper import discord, DiscordBot
-
-
+from database import Database
+from delivery import DeliveryScheduler
+from discord_wrapper import discord, DiscordBot, parse_id
+from logs import Logging
+from memory_storage import MemoryStorage
+from metrics import Metrics, export_periodically, measure_loop_lag
+from outbox import Outbox
+from scheduler import Scheduler
+from storage import Storage
+from users import UserDirectory
+
+
+# "sqlite" keeps events in DATABASE_FILE. "memory" keeps them in memory, with a snapshot in MEMORY_FILE and
+# a journal next to it, which is faster but only works with a single shard.
+STORAGE = 'sqlite'
 DATABASE_FILE = 'santa.db'
-DATABASE_SCHEMA = 'santa.sql'
+DATABASE_MIGRATIONS = 'migrations'
+MEMORY_FILE = 'santa.json'
+# Finished and reset events are moved to this file instead of being deleted
+ARCHIVE_FILE = 'santa-archive.db'
+# Events are archived this many seconds after their recipients were assigned
+ARCHIVE_AFTER = 60 * 24 * 3600
+# Seconds between archiving finished events and releasing free database pages, at most VACUUM_PAGES at a time
+MAINTENANCE_INTERVAL = 3600.0
+VACUUM_PAGES = 2000
 DESCRIPTION = ("This bot allows to conduct a Secret Santa event in Discord servers! "
                "It is specifically optimized for digital presents, such as game codes, gift cards etc, "
                "which the bot can send anonymously via direct messages.")
 MANAGEMENT_PERMISSIONS = discord.Permissions(manage_server=True)
 # noinspection SpellCheckingInspection
 PREFIX = 'ss!'
+# Scope -> (commands per second, burst) for all commands together, individual commands can add stricter ones.
+# The bursts leave room for everyone answering an announcement at once.
+RATE_LIMITS = {
+    'user': (0.5, 5),
+    'server': (10.0, 200),
+    'global': (100.0, 1000),
+}
 STATE_MESSAGES = {
     'collecting': 'It is too early to execute this command, since people are still able to join or leave.',
+    'closed': 'It is too late to execute this command, since joining and leaving the event was closed.',
     'distributed': 'It is too late to execute this command, since all Secret Santas were already assigned.',
 
     # Messages below do not correspond to server states
@@ -29,57 +61,115 @@ STATE_MESSAGES = {
 }
 # noinspection SpellCheckingInspection
 TOKEN = 'INSERT_TOKEN_HERE'
+# Commands are defined by the modules of this package, which can be reloaded while the bot is running
+COMMAND_PACKAGE = 'handlers'
+# User IDs allowed to run commands which affect the whole bot rather than a single server
+OWNER_IDS = set()  # type: typing.Set[str]
+# Senders who have not submitted their gift are reminded at most once in this many seconds
+REMINDER_INTERVAL = 12 * 3600
+# Actions can be scheduled at most this many seconds ahead
+SCHEDULE_HORIZON = 366 * 24 * 3600
+# Load all server states into memory on startup instead of on their first command
+WARM_SERVER_CACHE = True
+# Metrics in Prometheus text format are written to this file every METRICS_INTERVAL seconds
+METRICS_FILE = 'santabot-{shard}.prom'
+METRICS_INTERVAL = 15.0
+# Captures of the profile command are written to this file, and stop after at most PROFILE_MAX_SECONDS
+PROFILE_FILE = 'santabot-{shard}-{time}.pstats'
+PROFILE_MAX_SECONDS = 300
+# Set by the launcher for every shard process, a single process connects without sharding
+SHARD_ID = int(os.environ.get('SANTABOT_SHARD_ID', 0))
+SHARD_COUNT = int(os.environ.get('SANTABOT_SHARD_COUNT', 1))
 
 DISCORD_USER_ID_REGEX = re.compile(r'(?<=<@)\d+?(?=>)')
-bot = DiscordBot(TOKEN, PREFIX)
+log = logging.getLogger('santabot')
+logs = Logging()
+metrics = Metrics()
+bot = DiscordBot(
+    TOKEN,
+    PREFIX,
+    RATE_LIMITS,
+    metrics,
+    shard_id=SHARD_ID if SHARD_COUNT > 1 else None,
+    shard_count=SHARD_COUNT if SHARD_COUNT > 1 else None,
+)
+db = MemoryStorage(MEMORY_FILE) if STORAGE == 'memory' else Database(
+    DATABASE_FILE,
+    cacheable=lambda server_id: shard_of(server_id) == SHARD_ID,
+    archive_path=ARCHIVE_FILE,
+)  # type: Storage
+db.on_query = metrics.observe_query
+users = UserDirectory(bot.client)
+delivery = DeliveryScheduler(bot.client, users=users)
+outbox = Outbox(db, delivery, SHARD_ID, SHARD_COUNT)
+
+metrics.gauge('santabot_delivery_queue_depth', lambda: delivery.queue_depth)
+metrics.gauge('santabot_command_queue_depth', lambda: bot.dispatcher.pending)
+metrics.gauge('santabot_command_queue_rejected', lambda: bot.dispatcher.rejected)
+if db.server_cache is not None:
+    metrics.gauge('santabot_server_cache_hits', lambda: db.server_cache.hits)
+    metrics.gauge('santabot_server_cache_misses', lambda: db.server_cache.misses)
+metrics.gauge('santabot_database_commits', lambda: db.commits)
+metrics.gauge('santabot_database_writes', lambda: db.writes)
+metrics.gauge('santabot_log_records_dropped', lambda: logs.dropped)
+
+
+def shard_of(server_id):
+    # type: (str) -> int
 
+    # Same formula Discord uses to route a server's events to a shard. State changing commands only run
+    # in servers, so every server's state is only ever changed by the shard process it belongs to.
+    return (int(server_id) >> 22) % SHARD_COUNT
 
-def server_bind(allowed_states=None):
-    # type: (typing.Optional[typing.Set]) -> typing.Callable
+
+def server_bind(allowed_states=None, parts=frozenset()):
+    # type: (typing.Optional[typing.Set], typing.AbstractSet[str]) -> typing.Callable
+
+    # Commands get a Context with the server's state and budget, and whichever of the "participant",
+    # "sender" and "assignment" parts they ask for, all loaded with a single database query
 
     def new_function(func):
         # type: (typing.Callable) -> typing.Callable
 
-        def wrapper(message, data):
+        @functools.wraps(func)
+        async def wrapper(message, data):
             # type: (discord.Message, str) -> str
 
+            users.remember(message.author)
+
             # DETERMINE THE SERVER ID
             if message.server is None:
                 data = data.split(' ', 1)
-                if not data[0].isnumeric():
+                server_id = parse_id(data[0])
+
+                if server_id is None:
+                    # Digits which are no valid ID cannot belong to any server
+                    if data[0].isnumeric():
+                        return STATE_MESSAGES['none']
+
                     return ('The first command argument has to be the server ID. '
                             'To find the server ID, use the `id` command in the server.')
 
-                message.server = discord.Server(id=data[0])
+                message.server = discord.Server(id=server_id)
                 data = data[1] if len(data) == 2 else ''
 
-            # DETERMINE SERVER'S CURRENT STATE
-            cur.execute(
-                'SELECT `state`, `budget` FROM `servers` WHERE `server_id` = ?',
-                (message.server.id,)
-            )
-            res = cur.fetchall()
-
-            if len(res) == 1:
-                # Exactly one record exists
-                state = res[0][0]
-                budget = 'not set' if res[0][1] == '' else res[0][1]
-            elif len(res) == 0:
-                # No records exist
-                state = 'none'
-                budget = 'not set'
-            else:
-                # More than one record exist
-                state = 'inconsistent'
-                budget = 'not set'
+            # DETERMINE SERVER'S CURRENT STATE AND THE CALLER'S PART IN IT
+            ctx = await db.get_context(message.server.id, message.author.id, parts)
+
+            if ctx.budget == '':
+                ctx.budget = 'not set'
 
             # ACT DEPENDING ON THE STATE
-            if allowed_states is None or state in allowed_states:
-                return func(message, data, state, budget)
+            if allowed_states is None or ctx.state in allowed_states:
+                return await func(message, data, ctx)
             else:
-                print('Got state {} with allowed states {}.'.format(state, allowed_states))
-                if state in STATE_MESSAGES:
-                    return STATE_MESSAGES[state]
+                log.info('wrong state', extra={
+                    'server_id': message.server.id,
+                    'state': ctx.state,
+                    'allowed_states': sorted(allowed_states),
+                })
+                if ctx.state in STATE_MESSAGES:
+                    return STATE_MESSAGES[ctx.state]
                 else:
                     return STATE_MESSAGES['_']
 
@@ -88,454 +178,105 @@ def server_bind(allowed_states=None):
     return new_function
 
 
-async def send_info(sender_id, recipient_id, wish, budget):
-    # TODO refactor
-    sender = discord.User(id=sender_id)
-    recipient = await bot.client.get_user_info(recipient_id)  # type: discord.User
-
-    if wish == '':
-        wish = 'not set'
-
-    msg = 'Your secret gift recipient is <@{}> ({}). The budget is {}. Their wish is: {}'.format(
-        recipient_id,
-        recipient.name,
-        budget,
-        wish,
-    )
-
-    asyncio.run_coroutine_threadsafe(bot.client.send_message(sender, msg), asyncio.get_event_loop())
-
-
-@bot.command(
-    'join',
-    description='Join an ongoing event (and optionally specify your wishes).',
-    can_run_direct=False,
-)
-@server_bind({'collecting'})
-def cmd_join(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'SELECT `recipient_id` FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ?',
-        (message.server.id, message.author.id)
-    )
-    res = cur.fetchall()
-
-    # Only let through users with no records in "recipients"
-    if len(res) == 1:
-        return 'You have already joined this Secret Santa event.'
-    elif len(res) > 1:
-        return STATE_MESSAGES['inconsistent']
-
-    cur.execute(
-        'INSERT INTO `recipients` (`server_id`, `recipient_id`, `wish`) VALUES (?, ?, ?)',
-        (message.server.id, message.author.id, data)
-    )
-    conn.commit()
-
-    return 'You have successfully joined the Secret Santa event!'
-
-
-@bot.command(
-    'leave',
-    description='Leave an ongoing event.',
-)
-@server_bind({'collecting'})
-def cmd_leave(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'SELECT `recipient_id` FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ?',
-        (message.server.id, message.author.id)
-    )
-    res = cur.fetchall()
-
-    # Only let through users with a single record in "recipients"
-    if len(res) == 0:
-        return STATE_MESSAGES['not_part']
-    elif len(res) > 1:
-        return STATE_MESSAGES['inconsistent']
-
-    cur.execute(
-        'DELETE FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ?',
-        (message.server.id, message.author.id)
-    )
-    conn.commit()
-
-    return 'You have successfully left the Secret Santa event. See you again soon!'
-
-
-@bot.command(
-    'wish',
-    description='Update your wishes.',
-)
-@server_bind({'collecting', 'distributed'})
-def cmd_wish(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'SELECT `recipient_id` FROM `recipients` WHERE `server_id` = ? AND `recipient_id` = ?',
-        (message.server.id, message.author.id)
-    )
-    res = cur.fetchall()
-
-    # Only let through users with a single record in "recipients"
-    if len(res) == 0:
-        return STATE_MESSAGES['not_part']
-    elif len(res) > 1:
-        return STATE_MESSAGES['inconsistent']
-
-    cur.execute(
-        'UPDATE `recipients` SET `wish` = ? WHERE `server_id` = ? AND `recipient_id` = ?',
-        (data, message.server.id, message.author.id)
-    )
-    conn.commit()
-
-    return 'Your wishes have been updated!'
-
-
-@bot.command(
-    'submit',
-    description='Submit your gift for the recipient (**please use direct messages**).',
-    can_run_server=False,
-)
-@server_bind({'distributed'})
-def cmd_submit(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'SELECT `recipient_id` FROM `senders` WHERE `server_id` = ? AND `sender_id` = ?',
-        (message.server.id, message.author.id)
-    )
-    res = cur.fetchall()
-
-    # Only let through users with a single record in "senders"
-    if len(res) == 0:
-        return STATE_MESSAGES['not_part']
-    elif len(res) > 1:
-        return STATE_MESSAGES['inconsistent']
-
-    recipient_id = res[0][0]
-
-    cur.execute(
-        'UPDATE `senders` SET `gift` = ? WHERE `server_id` = ? AND `sender_id` = ?',
-        (data, message.server.id, message.author.id)
-    )
-    conn.commit()
-
-    return 'Your gift for <@{}> on server with ID {} was successfully submitted!'.format(
-        recipient_id,
-        message.server.id
-    )
-
-
-@bot.command(
-    'who',
-    description='Find out who is your secret gift recipient (answered via direct messages).',
-)
-@server_bind({'distributed'})
-def cmd_who(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        '''SELECT `senders`.`recipient_id`, `recipients`.`wish`
-        FROM `senders` INNER JOIN `recipients` ON `senders`.`recipient_id` = `recipients`.`recipient_id`
-        WHERE `senders`.`server_id` = ? AND `recipients`.`server_id` = ?
-        AND `senders`.`sender_id` = ?''',
-        (message.server.id, message.server.id, message.author.id)
-    )
-    res = cur.fetchall()
-
-    if len(res) == 0:
-        return STATE_MESSAGES['not_part']
-    elif len(res) > 1:
-        return STATE_MESSAGES['inconsistent']
-
-    recipient_id, wish = res[0][0], res[0][1]
-
-    asyncio.run_coroutine_threadsafe(send_info(message.author.id, recipient_id, wish, budget), asyncio.get_event_loop())
-
-    return 'Requested information sent via DM.'
-
-
-@bot.command(
-    'status',
-    description='Shows current event status and how many people are enrolled.',
-)
-@server_bind({'collecting', 'distributed'})
-def cmd_status(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'SELECT COUNT(`recipient_id`) FROM `recipients` WHERE `server_id` = ?',
-        (message.server.id,)
-    )
-    count = cur.fetchall()[0][0]
-
-    if state == 'collecting':
-        state_printable = 'Waiting for users to join, so far {} are in the event. Budget is {}.'.format(count, budget)
-    elif state == 'distributed':
-        state_printable = ('All Secret Santas were assigned respective gift recipients, {} are taking part. '
-                           'Budget is {}.').format(
-            count,
-            budget,
-        )
-    else:
-        state_printable = 'Secret Santa is currently in an unknown state. Try resetting it.'
-
-    return state_printable
-
-
-@bot.command(
-    'id',
-    description='Shows the current server ID, can be used for interacting with the bot via direct messages.',
-    can_run_direct=False,
-)
-@server_bind()
-def cmd_id(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    return 'This server\'s ID is {}.'.format(message.server.id)
-
-
-@bot.command(
-    'howto',
-    description='Displays a simple how-to for the Secret Santa bot.',
-)
-def cmd_howto(*_):
-    # type: (...) -> str
-
-    return ('Here is a short how-to for the Secret Santa bot:\n'
-            '**Join the Secret Santa event**\n'
-            '```{prefix}join <wish>```'
-            'where `wish` (optional) describes what you would like to receive as a gift.\n\n'
-            '**Change your wish**\n'
-            '```{prefix}wish <wish>```\n'
-            'If you want, you can set or update your wishes via DM with the bot, if you don\'t want '
-            'others to know what you want:'
-            '```{prefix}wish 123456789012345678 I want a big cat plushie```'
-            'where `123456789012345678` is the server\'s numeric identifier '
-            '(use the `{prefix}id` command in the server to view it).\n\n'
-            '**Leave the Secret Santa event**\n'
-            '```{prefix}leave```\n'
-            '**Find out who is your secret gift recipient** (answer comes via DM from bot):\n'
-            '```{prefix}who```\n'
-            '**Submit your gift** (DM the bot):\n'
-            '```{prefix}submit 123456789012345678 Here is you Steam code: ABCDE-12345```'
-            'where `123456789012345678` is the server\'s numeric identifier '
-            '(use the `{prefix}id` command in the server to view it), '
-            'followed by the gift itself (say some kind words too, why not).\n\n').format(prefix=PREFIX)
-
-
-@bot.command(
-    'help',
-    description='Displays this help message.',
-)
-def cmd_help(*_):
-    # type: (...) -> str
-
-    empty = discord.Permissions.none()
-
-    out = '{}\n\nAvailable commands:\n'.format(DESCRIPTION)
-    out += '\n'.join([
-        '`{}{:6}{}` `{}` `{}`\t{}{}'.format(
-            PREFIX,
-            key,
-            chr(0),
-            'S' if value.can_run_server else '-',
-            'D' if value.can_run_direct else '-',
-            value.description,
-            ' \\*' if value.required_permissions > empty else '',
-        )
-        for key, value in bot.commands.items()
-        if not value.is_hidden
-    ])
-    out += '\n\n`S` — command can be used in a server, `D` — command can be used via direct messages.'
-    return out
-
-
 @bot.command(
-    'squee',
-    description='Show credits.',
-    is_hidden=True,
-)
-def cmd_squee(*_):
-    # type: (...) -> str
-
-    return 'Bot crafted with love by Foster Snowhill (<@299908539940601856>) :heart:'
-
-
-@bot.command(
-    'start',
-    description='Start a new event.',
-    required_permissions=MANAGEMENT_PERMISSIONS,
-    can_run_direct=False,
-)
-@server_bind({'none'})
-def cmd_start(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'INSERT INTO `servers` (`server_id`, `state`, `budget`) VALUES (?, ?, ?)',
-        (message.server.id, 'collecting', data)
-    )
-    conn.commit()
-
-    return 'A Secret Santa event was successfully started!'
-
-
-@bot.command(
-    'reset',
-    description='Reset all Secret Santa data for this server.',
+    'reload',
+    description='Load the changed command modules without restarting the bot.',
     required_permissions=MANAGEMENT_PERMISSIONS,
-    can_run_direct=False,
-)
-@server_bind()
-def cmd_reset(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
-
-    cur.execute(
-        'DELETE FROM `servers` WHERE `server_id` = ?',
-        (message.server.id,)
-    )
-    cur.execute(
-        'DELETE FROM `recipients` WHERE `server_id` = ?',
-        (message.server.id,)
-    )
-    cur.execute(
-        'DELETE FROM `senders` WHERE `server_id` = ?',
-        (message.server.id,)
-    )
-    conn.commit()
-
-    return 'All Secret Santa data for this server has been reset.'
-
-
-@bot.command(
-    'assign',
-    description='Assign everyone their secret gift recipient.',
-    required_permissions=MANAGEMENT_PERMISSIONS,
-    can_run_direct=False,
+    is_hidden=True,
 )
-@server_bind({'collecting'})
-def cmd_assign(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
+def cmd_reload(message, data):
+    # type: (discord.Message, str) -> str
 
-    cur.execute(
-        'SELECT `recipient_id`, `wish` FROM `recipients` WHERE `server_id` = ?',
-        (message.server.id,)
-    )
-    res = cur.fetchall()
+    # Affects every server of this shard, so server permissions are not enough
+    if message.author.id not in OWNER_IDS:
+        return 'Only the owners of the bot can reload commands.'
 
-    wishes = {x[0]: x[1] for x in res}
+    try:
+        bot.load_commands(COMMAND_PACKAGE, [scheduler.actions])
+    except Exception as e:
+        log.exception('could not reload commands', extra={'user_id': message.author.id})
+        return 'Could not reload commands, the previous ones stay in place: `{}: {}`'.format(type(e).__name__, e)
 
-    if len(res) < 2:
-        return 'There has to be at least 2 users taking part in the Secret Santa event.'
+    log.info('reloaded commands', extra={'user_id': message.author.id, 'commands': len(bot.commands)})
+    return 'Reloaded {} commands on shard {}.'.format(len(bot.commands), SHARD_ID)
 
-    sender_ids = [x[0] for x in res]
-    recipient_ids = random.sample(sender_ids, k=len(sender_ids))
-    counter = 1
 
-    while any((sender_ids[i] == recipient_ids[i] for i in range(len(sender_ids)))):
-        recipient_ids = random.sample(sender_ids, k=len(sender_ids))
-        counter += 1
+async def run_action(server_id, action, channel_id):
+    # type: (str, str, str) -> None
 
-    mappings = []
-
-    loop = asyncio.get_event_loop()
-
-    for i in range(len(sender_ids)):
-        sender_id = sender_ids[i]
-        recipient_id = recipient_ids[i]
-
-        mappings.append((message.server.id, sender_id, recipient_id, ''))
+    # Scheduled actions take their turn in the server's queue, just like commands
+    while True:
+        try:
+            result = await bot.dispatcher.submit(server_id, scheduler.actions[action], server_id)
+            break
+        except asyncio.QueueFull:
+            await asyncio.sleep(1.0)
 
-        wish = wishes[recipient_id]
+    log.info('ran scheduled action', extra={'server_id': server_id, 'action': action})
 
-        asyncio.run_coroutine_threadsafe(send_info(sender_id, recipient_id, wish, budget), loop)
+    try:
+        await bot.client.send_message(discord.Object(id=channel_id), 'Scheduled `{}`: {}'.format(action, result))
+    except discord.HTTPException:
+        log.warning('could not post scheduled action result', extra={'server_id': server_id, 'channel_id': channel_id})
 
-    cur.executemany(
-        'INSERT INTO `senders` VALUES (?, ?, ?, ?)',
-        mappings
-    )
-    cur.execute(
-        'UPDATE `servers` SET `state` = "distributed" WHERE `server_id` = ?',
-        (message.server.id,)
-    )
-    conn.commit()
 
-    return ('{} secret Santas were assigned respective gift recipients! '
-            'Check your DMs. *Iterations required: {}.*').format(len(sender_ids), counter)
+scheduler = Scheduler(db, run_action, SHARD_ID, SHARD_COUNT)
+# The running capture of the profile command, there can only be one per process. Kept here rather than
+# with the command, so that reloading the commands does not lose track of it.
+profiler = None  # type: typing.Optional[cProfile.Profile]
 
 
-@bot.command(
-    'send',
-    description='Send everyone (or the specified user) their gifts.',
-    required_permissions=MANAGEMENT_PERMISSIONS,
-    can_run_direct=False,
-)
-@server_bind({'distributed'})
-def cmd_send(message, data, state, budget):
-    # type: (discord.Message, str, str, str) -> str
+async def maintain():
+    # type: () -> None
 
-    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
 
-    if data == '':
-        cur.execute(
-            'SELECT `recipient_id`, `gift` FROM `senders` WHERE `server_id` = ?',
-            (message.server.id,)
-        )
-        res = cur.fetchall()
+        try:
+            for server_id in await db.get_finished_events(int(time.time()) - ARCHIVE_AFTER, SHARD_ID, SHARD_COUNT):
+                await db.archive_event(server_id)
+                scheduler.forget(server_id)
 
-        for recipient_id, gift in res:
-            user = discord.User(id=recipient_id)
+            # Shards share the database file, one of them is enough to shrink it
+            if SHARD_ID == 0:
+                await db.incremental_vacuum(VACUUM_PAGES)
+        except Exception:
+            log.exception('database maintenance failed')
 
-            if gift == '':
-                msg = 'Unfortunately, your Secret Santa did not provide a gift :('
-            else:
-                msg = 'Here is your gift from a Secret Santa!\n{}'.format(gift)
 
-            asyncio.run_coroutine_threadsafe(bot.client.send_message(user, msg), loop)
+# Command modules import this module for the bot and its services, also when it is run as a script
+sys.modules.setdefault('santabot', sys.modules[__name__])
+bot.load_commands(COMMAND_PACKAGE, [scheduler.actions])
 
-        return 'Sent gifts to {} users!'.format(len(res))
-    else:
-        try:
-            recipient_id = DISCORD_USER_ID_REGEX.findall(data.replace('!', ''))[0]
-        except:
-            return 'Invalid target user ID.'
 
-        cur.execute(
-            'SELECT `gift` FROM `senders` WHERE `server_id` = ? AND `recipient_id` = ?',
-            (message.server.id, recipient_id)
-        )
-        res = cur.fetchall()
+def run():
+    # type: () -> None
 
-        if len(res) < 1:
-            return "Requested user didn't take part in this Secret Santa event."
+    logs.start()
 
-        gift = res[0][0]
+    bot.client.loop.run_until_complete(db.open(DATABASE_MIGRATIONS))
 
-        user = discord.User(id=recipient_id)
+    if WARM_SERVER_CACHE:
+        bot.client.loop.run_until_complete(db.warm_server_cache())
 
-        if gift == '':
-            msg = 'Unfortunately, your Secret Santa did not provide a gift :('
-        else:
-            msg = 'Here is your gift from a Secret Santa!\n{}'.format(gift)
+    # Actions which came due while the bot was down run right away
+    bot.client.loop.run_until_complete(scheduler.load())
 
-        asyncio.run_coroutine_threadsafe(bot.client.send_message(user, msg), loop)
+    bot.client.loop.create_task(measure_loop_lag(metrics))
+    # Picks up gift deliveries interrupted by a restart right away
+    bot.client.loop.create_task(outbox.run())
+    bot.client.loop.create_task(maintain())
+    bot.client.loop.create_task(export_periodically(metrics, METRICS_FILE.format(shard=SHARD_ID), METRICS_INTERVAL))
 
-        return 'Gift sent to the requested user.'
+    try:
+        bot.client.run(TOKEN)
+    except TypeError:
+        pass
+    finally:
+        scheduler.close()
+        db.close()
+        logs.stop()
 
 
 if __name__ == '__main__':
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cur = conn.cursor()
-
-        with open(DATABASE_SCHEMA, 'r') as f:
-            cur.executescript(f.read())
-            conn.commit()
-
-        try:
-            bot.client.run(TOKEN)
-        except TypeError:
-            pass
+    run()
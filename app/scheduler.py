@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import logging
+import time
+import typing
+
+from storage import Storage
+
+
+log = logging.getLogger(__name__)
+
+
+class Scheduler:
+    # Runs the actions scheduled for servers once their time has come. All of them are kept in a single heap
+    # ordered by time, and the event loop only has a timer for the earliest one, so waiting actions cost nothing
+    # but memory. Actions are stored in the database and loaded again at startup, those which came due while
+    # the bot was down run right away.
+    #
+    # An action is removed from the database only after it ran, one which was running when the process died runs
+    # again. Actions have to check the state of the event themselves, so that running one twice does no harm.
+
+    def __init__(self, db, run, shard_id=0, shard_count=1):
+        # type: (Storage, typing.Callable[[str, str, str], typing.Awaitable[None]], int, int) -> None
+
+        self.db = db
+        # Called with the server, the action and the channel it was scheduled from
+        self.run = run
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+
+        # Action name -> coroutine function taking the server ID and returning a message about how it went
+        self.actions = {}  # type: typing.Dict[str, typing.Callable[[str], typing.Awaitable[str]]]
+        # Server -> action -> (run at, channel), the heap may still have entries which were replaced since
+        self.pending = {}  # type: typing.Dict[str, typing.Dict[str, typing.Tuple[int, str]]]
+
+        self._heap = []  # type: typing.List[typing.Tuple[int, str, str]]
+        self._timer = None  # type: typing.Optional[asyncio.TimerHandle]
+        self._timer_at = None  # type: typing.Optional[int]
+
+    def action(self, name):
+        def decorator(func):
+            self.actions[name] = func
+            return func
+        return decorator
+
+    async def load(self):
+        # type: () -> None
+
+        for server_id, action, run_at, channel_id in await self.db.get_scheduled_actions(self.shard_id, self.shard_count):
+            self._push(server_id, action, run_at, channel_id)
+
+        self._arm()
+        log.info('loaded scheduled actions', extra={'count': len(self._heap)})
+
+    def get(self, server_id):
+        # type: (str) -> typing.Dict[str, typing.Tuple[int, str]]
+
+        return self.pending.get(server_id, {})
+
+    async def add(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        await self.db.schedule_action(server_id, action, run_at, channel_id)
+        self._push(server_id, action, run_at, channel_id)
+        self._arm()
+
+    async def cancel(self, server_id, action):
+        # type: (str, str) -> bool
+
+        if action not in self.get(server_id):
+            return False
+
+        await self.db.unschedule_action(server_id, action)
+        self._drop(server_id, action)
+        return True
+
+    def forget(self, server_id):
+        # type: (str) -> None
+
+        # For events which were reset, their rows are already gone from the database. The heap entries are
+        # skipped once they come up.
+        self.pending.pop(server_id, None)
+
+    def close(self):
+        # type: () -> None
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._timer_at = None
+
+    def _push(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        self.pending.setdefault(server_id, {})[action] = (run_at, channel_id)
+        heapq.heappush(self._heap, (run_at, server_id, action))
+
+    def _drop(self, server_id, action):
+        # type: (str, str) -> None
+
+        actions = self.pending.get(server_id, {})
+        actions.pop(action, None)
+
+        if len(actions) == 0:
+            self.pending.pop(server_id, None)
+
+    def _arm(self):
+        # type: () -> None
+
+        if len(self._heap) == 0 or self._heap[0][0] == self._timer_at:
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+
+        self._timer_at = self._heap[0][0]
+        self._timer = asyncio.get_event_loop().call_later(max(0.0, self._timer_at - time.time()), self._fire)
+
+    def _fire(self):
+        # type: () -> None
+
+        self._timer = self._timer_at = None
+        now = time.time()
+
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            run_at, server_id, action = heapq.heappop(self._heap)
+            entry = self.get(server_id).get(action)
+
+            # Cancelled or rescheduled to another time since it was pushed
+            if entry is None or entry[0] != run_at:
+                continue
+
+            self._drop(server_id, action)
+            asyncio.ensure_future(self._run(server_id, action, run_at, entry[1]))
+
+        self._arm()
+
+    async def _run(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        try:
+            await self.run(server_id, action, channel_id)
+        except Exception:
+            log.exception('scheduled action failed', extra={'server_id': server_id, 'action': action})
+
+        # Unless it was scheduled again while running
+        await self.db.unschedule_action(server_id, action, run_at)
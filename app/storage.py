@@ -0,0 +1,247 @@
+import typing
+
+from cache import LRUCache
+
+
+class Context:
+    # What a command needs to know about its server and its caller. Parts which were not requested
+    # from Storage.get_context are None, as are the ones which do not exist.
+
+    def __init__(
+            self,
+            state,
+            budget,
+            wish=None,
+            recipient_id=None,
+            gift=None,
+            recipient_wish=None,
+            participants=None,
+            gifts=None,
+    ):
+        # type: (str, str, typing.Optional[str], typing.Optional[str], typing.Optional[str], typing.Optional[str], typing.Optional[int], typing.Optional[int]) -> None
+
+        self.state = state
+        self.budget = budget
+        # "counts": how many users joined and how many of them submitted a gift
+        self.participants = participants
+        self.gifts = gifts
+        # "participant": the caller's own wish, set if they joined the event
+        self.wish = wish
+        # "sender": who the caller drew and the gift they submitted
+        self.recipient_id = recipient_id
+        self.gift = gift
+        # "assignment": the sender part plus the wish of the recipient
+        self.recipient_wish = recipient_wish
+
+
+class Storage:
+    # Everything the commands keep about events. Database stores it in SQLite, MemoryStorage in memory
+    # with a journal and snapshots on disk. User and server IDs are strings, as they come from Discord.
+
+    # Writes made and transactions (or journal flushes) they took
+    commits = 0
+    writes = 0
+    # Called with every statement and the seconds it took, by backends which have statements
+    on_query = None  # type: typing.Optional[typing.Callable[[str, float], None]]
+    # Recently used server rows, by backends which have to cache them
+    server_cache = None  # type: typing.Optional[LRUCache]
+
+    async def open(self, migrations_directory):
+        # type: (str) -> None
+
+        raise NotImplementedError()
+
+    def close(self):
+        # type: () -> None
+
+        raise NotImplementedError()
+
+    async def warm_server_cache(self):
+        # type: () -> None
+
+        pass
+
+    async def incremental_vacuum(self, pages):
+        # type: (int) -> int
+
+        return 0
+
+    # SERVERS
+
+    async def get_context(self, server_id, user_id, parts=frozenset()):
+        # type: (str, str, typing.AbstractSet[str]) -> Context
+
+        raise NotImplementedError()
+
+    async def start_event(self, server_id, budget):
+        # type: (str, str) -> bool
+
+        # False if an event was started in the meantime
+        raise NotImplementedError()
+
+    async def reset_event(self, server_id):
+        # type: (str) -> None
+
+        raise NotImplementedError()
+
+    async def close_event(self, server_id):
+        # type: (str) -> bool
+
+        # Ends joining and leaving, False if the event was not collecting
+        raise NotImplementedError()
+
+    async def assign(self, server_id, pairs):
+        # type: (str, typing.Dict[str, str]) -> bool
+
+        # False if the event was no longer collecting or closed, or if the pairs are not exactly its participants
+        # any more, e.g. because someone left on another shard after they were read
+        raise NotImplementedError()
+
+    # RECIPIENTS
+
+    async def get_recipient_ids(self, server_id):
+        # type: (str) -> typing.List[str]
+
+        raise NotImplementedError()
+
+    async def get_recipient_page(self, server_id, after, limit):
+        # type: (str, str, int) -> typing.List[str]
+
+        # The first "limit" recipients following the one with the ID "after", ordered by ID
+        raise NotImplementedError()
+
+    async def add_recipient(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> bool
+
+        # False if the user has already joined or the event is no longer collecting
+        raise NotImplementedError()
+
+    async def add_recipients(self, server_id, recipient_ids):
+        # type: (str, typing.Iterable[str]) -> None
+
+        raise NotImplementedError()
+
+    async def remove_recipient(self, server_id, recipient_id):
+        # type: (str, str) -> bool
+
+        # False if the user has already left or the event is no longer collecting
+        raise NotImplementedError()
+
+    async def remove_recipients(self, server_id, recipient_ids):
+        # type: (str, typing.Iterable[str]) -> None
+
+        raise NotImplementedError()
+
+    async def set_wish(self, server_id, recipient_id, wish):
+        # type: (str, str, str) -> None
+
+        raise NotImplementedError()
+
+    # SENDERS
+
+    async def set_gift(self, server_id, sender_id, gift):
+        # type: (str, str, str) -> None
+
+        raise NotImplementedError()
+
+    async def get_gifts(self, server_id, recipient_ids):
+        # type: (str, typing.Sequence[str]) -> typing.List[typing.Tuple[str, str]]
+
+        raise NotImplementedError()
+
+    def iter_assignments(self, server_id):
+        # type: (str) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str, str]]]
+
+        # Chunks of (sender, recipient, recipient's wish)
+        raise NotImplementedError()
+
+    def iter_gifts(self, server_id):
+        # type: (str) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str]]]
+
+        # Chunks of (recipient, gift)
+        raise NotImplementedError()
+
+    def iter_missing_gifts(self, server_id, reminded_before):
+        # type: (str, int) -> typing.AsyncIterator[typing.List[typing.Tuple[str, str]]]
+
+        # Chunks of (sender, recipient) who have not submitted their gift and were not reminded since
+        # "reminded_before"
+        raise NotImplementedError()
+
+    async def get_missing_gift_page(self, server_id, after, limit):
+        # type: (str, str, int) -> typing.List[str]
+
+        # The first "limit" senders without a gift following the one with the ID "after", ordered by ID
+        raise NotImplementedError()
+
+    async def set_reminded(self, server_id, sender_ids, reminded_at):
+        # type: (str, typing.Iterable[str], int) -> None
+
+        raise NotImplementedError()
+
+    # OUTBOX
+
+    async def queue_messages(self, server_id, kind, messages, resend=False):
+        # type: (str, str, typing.Sequence[typing.Tuple[str, str]], bool) -> None
+
+        raise NotImplementedError()
+
+    async def get_pending_messages(self, after, limit, shard_id=0, shard_count=1):
+        # type: (typing.Tuple[str, str, str], int, int, int) -> typing.List[typing.Tuple[str, str, str, str]]
+
+        # (server, kind, user, content) ordered by the first three, which "after" continues from
+        raise NotImplementedError()
+
+    async def set_message_state(self, server_id, kind, user_id, state):
+        # type: (str, str, str, str) -> None
+
+        raise NotImplementedError()
+
+    async def count_messages(self, server_id, kind):
+        # type: (str, str) -> typing.Dict[str, int]
+
+        raise NotImplementedError()
+
+    # SCHEDULE
+
+    async def schedule_action(self, server_id, action, run_at, channel_id):
+        # type: (str, str, int, str) -> None
+
+        # Replaces the server's earlier one of the same action
+        raise NotImplementedError()
+
+    async def unschedule_action(self, server_id, action, run_at=None):
+        # type: (str, str, typing.Optional[int]) -> None
+
+        # With "run_at" only if it was not rescheduled in the meantime
+        raise NotImplementedError()
+
+    async def get_scheduled_actions(self, shard_id=0, shard_count=1):
+        # type: (int, int) -> typing.List[typing.Tuple[str, str, int, str]]
+
+        # (server, action, run at, channel) of the servers belonging to the given shard
+        raise NotImplementedError()
+
+    # ARCHIVE
+
+    async def archive_event(self, server_id):
+        # type: (str) -> bool
+
+        # Whether the event was archived, False if there is none. Backends without an archive delete it.
+        raise NotImplementedError()
+
+    async def get_finished_events(self, before, shard_id=0, shard_count=1):
+        # type: (int, int, int) -> typing.List[str]
+
+        raise NotImplementedError()
+
+    async def get_archived_events(self, server_id, limit):
+        # type: (str, int) -> typing.List[typing.Tuple[int, int, str, str, int, int]]
+
+        raise NotImplementedError()
+
+    async def get_archived_event(self, server_id, event_id):
+        # type: (str, int) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]
+
+        # Every participant's ID, wish, recipient and whether they submitted a gift, the gifts are not archived
+        raise NotImplementedError()
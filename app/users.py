@@ -0,0 +1,70 @@
+import typing
+
+import discord
+
+from cache import TTLCache
+
+
+class UserDirectory:
+    # Users and their DM channels, so that fan-outs do not have to look up every user via the API.
+    # Whenever possible, the cache is filled from the member lists the gateway already sent us.
+
+    TTL = 6 * 60 * 60
+    MAX_SIZE = 100000
+
+    def __init__(self, client, ttl=TTL, max_size=MAX_SIZE):
+        # type: (discord.Client, float, int) -> None
+
+        self.client = client
+        self.users = TTLCache(max_size, ttl)
+        self.channels = TTLCache(max_size, ttl)
+        self.api_calls = 0
+
+    def remember(self, user):
+        # type: (discord.User) -> None
+
+        self.users.put(user.id, user)
+
+    def prefetch(self, server_id, user_ids):
+        # type: (str, typing.Iterable[str]) -> int
+
+        # Batch step before mass deliveries, returns how many users still have to be fetched via the API
+        server = self.client.get_server(server_id)
+        missing = 0
+
+        for user_id in user_ids:
+            if user_id in self.users:
+                continue
+
+            member = None if server is None else server.get_member(user_id)
+
+            if member is None:
+                missing += 1
+            else:
+                self.remember(member)
+
+        return missing
+
+    async def get_user(self, user_id):
+        # type: (str) -> discord.User
+
+        user = self.users.get(user_id)
+
+        if user is None:
+            self.api_calls += 1
+            user = await self.client.get_user_info(user_id)
+            self.remember(user)
+
+        return user
+
+    async def get_channel(self, user):
+        # type: (discord.User) -> discord.Channel
+
+        channel = self.channels.get(user.id)
+
+        if channel is None:
+            self.api_calls += 1
+            channel = await self.client.start_private_message(user)
+            self.channels.put(user.id, channel)
+
+        return channel
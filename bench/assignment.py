@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from assignment import assign, exclude_pairs  # noqa: E402
+
+
+COUNTS = (10, 100, 1000, 10000, 50000, 100000)
+RUNS = 20
+
+
+def run(count, couples):
+    # type: (int, bool) -> list
+
+    participants = [str(100000000000000000 + i) for i in range(count)]
+    excluded = exclude_pairs(zip(participants[0::2], participants[1::2])) if couples else None
+    rng = random.Random(count)
+    timings = []
+
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        mapping = assign(participants, excluded, rng)
+        timings.append((time.perf_counter() - started) * 1000)
+
+        assert len(mapping) == count and set(mapping.values()) == set(participants)
+        assert all(sender != recipient for sender, recipient in mapping.items())
+        assert not excluded or not any(pair in excluded for pair in mapping.items())
+
+    return timings
+
+
+if __name__ == '__main__':
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('users', 'couples', 'mean ms', 'stdev', 'min', 'max'))
+
+    for count in COUNTS:
+        for couples in (False, True):
+            timings = run(count, couples)
+            print('{:>8} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                count,
+                'yes' if couples else 'no',
+                statistics.mean(timings),
+                statistics.stdev(timings),
+                min(timings),
+                max(timings),
+            ))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Drives the santabot commands through DiscordBot.handle_message with fake Discord objects,
+# so the command path can be measured without a network connection.
+#
+# Usage: bench/commands.py [participants] [sqlite|memory]
+
+from collections import defaultdict
+
+import asyncio
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+
+import discord  # noqa: E402
+
+import santabot  # noqa: E402
+
+from database import Database  # noqa: E402
+from delivery import DeliveryScheduler  # noqa: E402
+from fake_discord import FakeClient, FakeMessage, FakeServer, FakeUser  # noqa: E402
+from logs import Logging  # noqa: E402
+from memory_storage import MemoryStorage  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from users import UserDirectory  # noqa: E402
+
+
+PARTICIPANTS = 2000
+MIXED_COMMANDS = 5000
+# Seconds between two messages of a storm, roughly a busy announcement channel
+STORM_INTERVAL = 0.0005
+# Simulated round trip of every Discord API call
+API_LATENCY = 0.002
+
+
+class Recorder:
+    def __init__(self):
+        # type: () -> None
+
+        self.latencies = defaultdict(list)  # type: typing.Dict[str, typing.List[float]]
+        self.sql_time = 0.0
+        self.sql_statements = 0
+
+    def on_query(self, sql, seconds):
+        # type: (str, float) -> None
+
+        self.sql_time += seconds
+        self.sql_statements += 1
+
+
+class Bench:
+    def __init__(self, participants, storage='sqlite'):
+        # type: (int, str) -> None
+
+        self.directory = tempfile.mkdtemp(prefix='santabot-bench-')
+        self.client = FakeClient(API_LATENCY)
+        self.admin = FakeUser('2', 'admin', discord.Permissions(manage_server=True))
+        self.server = FakeServer('100000000000000000', [self.admin])
+        self.users = [FakeUser(str(200000000000000000 + i)) for i in range(participants)]
+        self.recorder = None  # type: typing.Optional[Recorder]
+
+        for user in self.users:
+            self.server.add_member(user)
+        self.client.servers.append(self.server)
+
+        # Point everything the commands use at the fake client and a scratch database
+        santabot.bot.client = self.client
+        santabot.bot.throttle.enabled = False
+        # Storms are not throttled here, so every command of them has to fit into the server's queue
+        santabot.bot.dispatcher.queue_size = max(participants, MIXED_COMMANDS)
+        santabot.logs = Logging(open(os.devnull, 'w'))
+        if storage == 'memory':
+            santabot.db = MemoryStorage(os.path.join(self.directory, 'santa.json'))
+        else:
+            santabot.db = Database(os.path.join(self.directory, 'santa.db'))
+        santabot.db.on_query = self.on_query
+        santabot.users = UserDirectory(self.client)
+        santabot.delivery = DeliveryScheduler(
+            self.client,
+            concurrency=32,
+            routes={'dm': (1e6, 1e6)},
+            users=santabot.users,
+        )
+        santabot.outbox = Outbox(santabot.db, santabot.delivery)
+        santabot.scheduler.db = santabot.db
+
+    def on_query(self, sql, seconds):
+        # type: (str, float) -> None
+
+        if self.recorder is not None:
+            self.recorder.on_query(sql, seconds)
+
+    async def command(self, author, content, server=None):
+        # type: (FakeUser, str, typing.Optional[FakeServer]) -> None
+
+        started = time.perf_counter()
+        await santabot.bot.handle_message(FakeMessage(author, content, server))
+        self.recorder.latencies[content.split()[0]].append(time.perf_counter() - started)
+
+    async def storm(self, commands):
+        # type: (typing.Iterable[typing.Tuple[FakeUser, str, typing.Optional[FakeServer]]]) -> None
+
+        tasks = []
+        for author, content, server in commands:
+            tasks.append(asyncio.ensure_future(self.command(author, content, server)))
+            await asyncio.sleep(STORM_INTERVAL)
+
+        await asyncio.gather(*tasks)
+
+    async def drain(self):
+        # type: () -> None
+
+        while any(job.finished is None for job in santabot.delivery.progress(self.server.id)) or \
+                (await santabot.db.count_messages(self.server.id, 'gift')).get('pending', 0) > 0:
+            await asyncio.sleep(0.001)
+
+    async def phase(self, name, workload):
+        # type: (str, typing.Awaitable) -> None
+
+        self.recorder = Recorder()
+        commits = santabot.db.commits
+        api_calls = self.client.api_calls
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await workload
+        elapsed = time.perf_counter() - started
+
+        count = sum(len(x) for x in self.recorder.latencies.values())
+        latencies = sorted(x for values in self.recorder.latencies.values() for x in values)
+
+        print('{:<14} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>11.3f} {:>8} {:>9}'.format(
+            name,
+            count,
+            count / elapsed,
+            statistics.median(latencies) * 1000,
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            self.recorder.sql_time * 1000 / count,
+            santabot.db.commits - commits,
+            self.client.api_calls - api_calls,
+        ))
+
+    async def run(self):
+        # type: () -> None
+
+        await santabot.db.open(os.path.join(ROOT, 'migrations'))
+        outbox = asyncio.ensure_future(santabot.outbox.run())
+        santabot.logs.start()
+        server = self.server
+        rng = random.Random(1)
+
+        print('{:<14} {:>7} {:>9} {:>9} {:>9} {:>11} {:>8} {:>9}'.format(
+            'workload', 'cmds', 'cmds/s', 'p50 ms', 'p99 ms', 'sql ms/cmd', 'commits', 'API calls'
+        ))
+
+        await self.phase('start', self.command(self.admin, 'ss!start 20 EUR', server))
+
+        await self.phase('join storm', self.storm(
+            (user, 'ss!join I want a plushie', server) for user in self.users
+        ))
+
+        await self.phase('assign', self.assign())
+
+        await self.phase('submit', self.storm(
+            (user, 'ss!submit {} CODE-{}'.format(server.id, user.id), None) for user in self.users
+        ))
+
+        await self.phase('mixed', self.storm(
+            (rng.choice(self.users), rng.choice(('ss!status', 'ss!who', 'ss!wish a kitten')), server)
+            for _ in range(MIXED_COMMANDS)
+        ))
+
+        await self.phase('send', self.send())
+
+        outbox.cancel()
+        santabot.bot.dispatcher.close()
+        santabot.delivery.close()
+        santabot.db.close()
+        santabot.logs.stop()
+
+    async def assign(self):
+        # type: () -> None
+
+        await self.command(self.admin, 'ss!assign', self.server)
+        await self.drain()
+
+    async def send(self):
+        # type: () -> None
+
+        await self.command(self.admin, 'ss!send', self.server)
+        await self.drain()
+
+
+if __name__ == '__main__':
+    bench = Bench(
+        int(sys.argv[1]) if len(sys.argv) > 1 else PARTICIPANTS,
+        sys.argv[2] if len(sys.argv) > 2 else 'sqlite',
+    )
+    asyncio.get_event_loop().run_until_complete(bench.run())
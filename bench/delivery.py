@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import discord  # noqa: E402
+
+from delivery import DeliveryScheduler  # noqa: E402
+from ratelimit import TokenBucket  # noqa: E402
+
+
+COUNTS = (100, 500, 2000)
+# The fake API lets through this many DMs per second (with the same burst) and rejects the rest with 429
+LIMIT = 200.0
+# Share of requests failing with a server error, to exercise retries
+ERROR_RATE = 0.01
+
+
+class FakeResponse:
+    def __init__(self, status, retry_after=0.0):
+        # type: (int, float) -> None
+
+        self.status = status
+        self.reason = 'Too Many Requests' if status == 429 else 'Internal Server Error'
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+class FakeClient:
+    def __init__(self, limit):
+        # type: (float) -> None
+
+        self.bucket = TokenBucket(limit, limit)
+        self.delivered = {}
+        self.rejected = 0
+        self.errors = 0
+
+    async def send_message(self, destination, content):
+        # type: (discord.User, str) -> str
+
+        # Simulated network round trip
+        await asyncio.sleep(0.005)
+
+        if not self.bucket.try_acquire():
+            self.rejected += 1
+            raise discord.HTTPException(FakeResponse(429, self.bucket.delay()), 'rate limited')
+
+        if random.random() < ERROR_RATE:
+            self.errors += 1
+            raise discord.HTTPException(FakeResponse(500), 'server error')
+
+        self.delivered[destination.id] = content
+        return content
+
+
+async def run(count):
+    # type: (int) -> None
+
+    client = FakeClient(LIMIT)
+    scheduler = DeliveryScheduler(client, concurrency=16, routes={'dm': (LIMIT, LIMIT)}, backoff=0.05)
+
+    started = time.perf_counter()
+    job = scheduler.submit('1', 'bench', [(discord.User(id=str(i)), 'gift {}'.format(i)) for i in range(count)])
+
+    while job.finished is None:
+        await asyncio.sleep(0.01)
+
+    elapsed = time.perf_counter() - started
+    scheduler.close()
+    await asyncio.sleep(0)
+
+    assert job.sent == len(client.delivered) == count, (job.sent, len(client.delivered))
+
+    print('{:>6} {:>8.2f} {:>10.1f} {:>8} {:>8} {:>8}'.format(
+        count,
+        elapsed,
+        count / elapsed,
+        client.rejected,
+        client.errors,
+        job.failed,
+    ))
+
+
+if __name__ == '__main__':
+    print('Rate limit: {:.0f} DMs/s'.format(LIMIT))
+    print('{:>6} {:>8} {:>10} {:>8} {:>8} {:>8}'.format('DMs', 'seconds', 'DMs/s', '429s', 'errors', 'lost'))
+
+    loop = asyncio.get_event_loop()
+    for count in COUNTS:
+        loop.run_until_complete(run(count))
@@ -0,0 +1,120 @@
+import asyncio
+import typing
+
+import discord
+
+
+class FakeUser:
+    def __init__(self, user_id, name=None, permissions=None):
+        # type: (str, typing.Optional[str], typing.Optional[discord.Permissions]) -> None
+
+        self.id = user_id
+        self.name = name or 'user{}'.format(user_id)
+        self.display_name = self.name
+        self.discriminator = '0001'
+        self.bot = False
+        self.roles = []  # type: typing.List[FakeRole]
+        self.server_permissions = permissions or discord.Permissions.none()
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeRole:
+    def __init__(self, role_id, name):
+        # type: (str, str) -> None
+
+        self.id = role_id
+        self.name = name
+
+
+class FakeChannel:
+    def __init__(self, channel_id, is_private):
+        # type: (str, bool) -> None
+
+        self.id = channel_id
+        self.is_private = is_private
+
+
+class FakeServer:
+    def __init__(self, server_id, members=()):
+        # type: (str, typing.Iterable[FakeUser]) -> None
+
+        self.id = server_id
+        self.members = list(members)
+        self.roles = []  # type: typing.List[FakeRole]
+        self._members = {member.id: member for member in self.members}
+
+    def add_member(self, member):
+        # type: (FakeUser) -> None
+
+        self.members.append(member)
+        self._members[member.id] = member
+
+    def get_member(self, user_id):
+        # type: (str) -> typing.Optional[FakeUser]
+
+        return self._members.get(user_id)
+
+
+class FakeMessage:
+    def __init__(self, author, content, server=None, mentions=(), role_mentions=()):
+        # type: (FakeUser, str, typing.Optional[FakeServer], typing.Iterable[FakeUser], typing.Iterable[FakeRole]) -> None
+
+        self.author = author
+        self.content = content
+        self.server = server
+        self.channel = FakeChannel('0' if server is None else server.id, server is None)
+        self.mentions = list(mentions)
+        self.role_mentions = list(role_mentions)
+
+
+class FakeClient:
+    # Stands in for discord.Client, every API call takes a simulated round trip and is counted
+
+    def __init__(self, latency=0.0):
+        # type: (float) -> None
+
+        self.latency = latency
+        self.user = FakeUser('1', 'santabot')
+        self.servers = []  # type: typing.List[FakeServer]
+        self.api_calls = 0
+        self.messages = []  # type: typing.List[typing.Tuple[str, str]]
+
+    async def _call(self):
+        # type: () -> None
+
+        self.api_calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def get_server(self, server_id):
+        # type: (str) -> typing.Optional[FakeServer]
+
+        for server in self.servers:
+            if server.id == server_id:
+                return server
+
+        return None
+
+    async def get_user_info(self, user_id):
+        # type: (str) -> FakeUser
+
+        await self._call()
+        return FakeUser(user_id)
+
+    async def start_private_message(self, user):
+        # type: (FakeUser) -> FakeChannel
+
+        await self._call()
+        return FakeChannel('dm{}'.format(user.id), True)
+
+    async def send_message(self, destination, content):
+        # type: (typing.Any, str) -> str
+
+        await self._call()
+        self.messages.append((destination.id, content))
+        return content
@@ -0,0 +1,48 @@
+-- Discord snowflakes are stored as integers instead of text, participants and pairings are clustered by
+-- (server_id, user_id) in WITHOUT ROWID tables, so lookups by their primary key need no separate index.
+
+CREATE TABLE "servers_new" (
+"server_id" INTEGER PRIMARY KEY,
+"state" TEXT NOT NULL,
+"budget" TEXT NOT NULL DEFAULT ''
+);
+
+INSERT INTO "servers_new" ("server_id", "state", "budget")
+SELECT CAST("server_id" AS INTEGER), "state", IFNULL("budget", '') FROM "servers";
+
+DROP TABLE "servers";
+ALTER TABLE "servers_new" RENAME TO "servers";
+
+
+CREATE TABLE "recipients_new" (
+"server_id" INTEGER NOT NULL,
+"recipient_id" INTEGER NOT NULL,
+"wish" TEXT NOT NULL DEFAULT '',
+PRIMARY KEY ("server_id", "recipient_id")
+) WITHOUT ROWID;
+
+INSERT INTO "recipients_new" ("server_id", "recipient_id", "wish")
+SELECT CAST("server_id" AS INTEGER), CAST("recipient_id" AS INTEGER), IFNULL("wish", '') FROM "recipients";
+
+DROP TABLE "recipients";
+ALTER TABLE "recipients_new" RENAME TO "recipients";
+
+
+CREATE TABLE "senders_new" (
+"server_id" INTEGER NOT NULL,
+"sender_id" INTEGER NOT NULL,
+"recipient_id" INTEGER NOT NULL,
+"gift" TEXT NOT NULL DEFAULT '',
+PRIMARY KEY ("server_id", "sender_id")
+) WITHOUT ROWID;
+
+INSERT INTO "senders_new" ("server_id", "sender_id", "recipient_id", "gift")
+SELECT CAST("server_id" AS INTEGER), CAST("sender_id" AS INTEGER), CAST("recipient_id" AS INTEGER), IFNULL("gift", '')
+FROM "senders";
+
+DROP TABLE "senders";
+ALTER TABLE "senders_new" RENAME TO "senders";
+
+-- Gift lookup by recipient in "send". Everyone receives exactly one gift, hence unique. Index entries carry
+-- the primary key, so they lead straight to the row
+CREATE UNIQUE INDEX "senders_recipient_index" ON "senders" ("server_id", "recipient_id");
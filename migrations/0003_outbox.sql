@@ -0,0 +1,16 @@
+-- Messages which have to be delivered even if the bot restarts in the middle of a fan-out. Every message is
+-- keyed by what it is for, so queueing the same message again is a no-op once it has been delivered.
+-- "state" is one of "pending", "sent" or "failed".
+
+CREATE TABLE "outbox" (
+"server_id" INTEGER NOT NULL,
+"kind" TEXT NOT NULL,
+"user_id" INTEGER NOT NULL,
+"content" TEXT NOT NULL,
+"state" TEXT NOT NULL DEFAULT 'pending',
+"attempts" INTEGER NOT NULL DEFAULT 0,
+PRIMARY KEY ("server_id", "kind", "user_id")
+) WITHOUT ROWID;
+
+-- The delivery worker only ever scans pending messages, which are few compared to the delivered ones
+CREATE INDEX "outbox_pending_index" ON "outbox" ("server_id", "kind", "user_id") WHERE "state" = 'pending';
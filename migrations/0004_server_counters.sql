@@ -0,0 +1,9 @@
+-- Participants and submitted gifts are counted by the writes changing them, so that "status" does not have
+-- to count the rows of a server every time it is asked
+
+ALTER TABLE "servers" ADD COLUMN "participants" INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE "servers" ADD COLUMN "gifts" INTEGER NOT NULL DEFAULT 0;
+
+UPDATE "servers" SET
+"participants" = (SELECT COUNT(*) FROM "recipients" WHERE "recipients"."server_id" = "servers"."server_id"),
+"gifts" = (SELECT COUNT(*) FROM "senders" WHERE "senders"."server_id" = "servers"."server_id" AND "senders"."gift" != '');
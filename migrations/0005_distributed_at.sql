@@ -0,0 +1,6 @@
+-- When the recipients were assigned, in seconds since the epoch. Finished events are moved to the archive
+-- some time after that, events assigned before this column existed count from the time of the migration.
+
+ALTER TABLE "servers" ADD COLUMN "distributed_at" INTEGER;
+
+UPDATE "servers" SET "distributed_at" = CAST(strftime('%s', 'now') AS INTEGER) WHERE "state" = 'distributed';
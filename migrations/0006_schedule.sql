@@ -0,0 +1,11 @@
+-- Actions which run by themselves at "run_at", in seconds since the epoch: "close" ends joining and leaving,
+-- "assign" assigns the recipients and "send" sends the gifts. A server has at most one of each, their result
+-- is posted to the channel they were scheduled from.
+
+CREATE TABLE "schedule" (
+"server_id" INTEGER NOT NULL,
+"action" TEXT NOT NULL,
+"run_at" INTEGER NOT NULL,
+"channel_id" INTEGER NOT NULL,
+PRIMARY KEY ("server_id", "action")
+) WITHOUT ROWID;
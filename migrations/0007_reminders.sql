@@ -0,0 +1,6 @@
+-- When the sender was last reminded to submit their gift, in seconds since the epoch. Reminders only look
+-- at the senders who have not submitted one, which become few as the event goes on.
+
+ALTER TABLE "senders" ADD COLUMN "reminded_at" INTEGER;
+
+CREATE INDEX "senders_missing_gift_index" ON "senders" ("server_id", "sender_id", "reminded_at", "recipient_id") WHERE "gift" = '';